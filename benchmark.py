@@ -0,0 +1,432 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import socket
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.parallel import DistributedDataParallel
+from modeling.deeplab import DeepLab
+from modeling.sync_batchnorm import SynchronizedBatchNorm2d, use_process_group
+from modeling.checkpointing import GRANULARITIES
+from modeling.aspp import ASPP_TYPES
+from utils.loss import SegmentationLosses
+from utils.calculate_weights import calculate_weights_batch
+from utils.profiling import SavedTensorMeter, time_call, format_bytes, profile_modules
+from utils.saver import Saver
+
+
+def build_model(args, backbone=None, sync_bn=False):
+        model = DeepLab(num_classes=args.num_classes,
+                        backbone=backbone or args.backbone,
+                        output_stride=args.out_stride,
+                        sync_bn=sync_bn,
+                        depth=args.depth,
+                        pretrained=False,
+                        aspp=args.aspp)
+        return model.to(args.device)
+
+
+def random_batch(args):
+        channels = 4 if args.depth else 3
+        image = torch.randn(args.batch_size, channels, args.crop_size, args.crop_size,
+                            device=args.device)
+        target = torch.randint(0, args.num_classes, (args.batch_size, args.crop_size // 32, args.crop_size // 32))
+        # blocky labels so that boundaries are as sparse as in the real masks
+        target = target.repeat_interleave(32, 1).repeat_interleave(32, 2).float().to(args.device)
+        return image, target
+
+
+def print_table(header, rows):
+        widths = [max(len(str(r[i])) for r in [header] + rows) for i in range(len(header))]
+        fmt = '  '.join('{:<%d}' % w for w in widths)
+        print(fmt.format(*header))
+        for row in rows:
+                print(fmt.format(*row))
+
+
+def bench_loss_res(args):
+        """Training step with the loss at full vs decoder resolution."""
+        model = build_model(args)
+        model.train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+        criterion = SegmentationLosses(cuda=args.device.startswith('cuda'))
+        image, target = random_batch(args)
+        weight = torch.from_numpy(calculate_weights_batch({'label': target}, args.num_classes).astype(np.float32))
+
+        def step(resolution, boundary_weight):
+                optimizer.zero_grad()
+                if resolution == 'decoder':
+                        output, _, _ = model(image, resolution='decoder')
+                        loss = criterion.LowResCrossEntropyLoss(output, target, weight=weight,
+                                                                boundary_weight=boundary_weight)
+                else:
+                        output, _, _ = model(image)
+                        loss = criterion.CrossEntropyLoss(output, target, weight=weight)
+                loss.backward()
+                optimizer.step()
+
+        rows = []
+        for resolution, boundary_weight in [('full', 0.0), ('decoder', 0.0), ('decoder', args.boundary_weight)]:
+                with SavedTensorMeter() as meter:
+                        step(resolution, boundary_weight)
+                if args.device.startswith('cuda'):
+                        torch.cuda.reset_peak_memory_stats()
+                seconds = time_call(lambda: step(resolution, boundary_weight),
+                                    iters=args.iters, warmup=args.warmup, device=args.device)
+                peak = format_bytes(torch.cuda.max_memory_allocated()) if args.device.startswith('cuda') else '-'
+                rows.append([resolution, boundary_weight, '%.3f' % seconds,
+                             format_bytes(meter.nbytes), peak])
+        print_table(['loss-res', 'boundary', 'step (s)', 'saved activations', 'cuda peak'], rows)
+
+
+def bench_channels_last(args):
+        """Images/sec of inference and training steps, NCHW vs channels_last."""
+        rows = []
+        for backbone in args.backbones:
+                for memory_format in [torch.contiguous_format, torch.channels_last]:
+                        model = build_model(args, backbone).set_memory_format(memory_format)
+                        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+                        image, target = random_batch(args)
+                        image = image.contiguous(memory_format=memory_format)
+
+                        def infer():
+                                with torch.no_grad():
+                                        model(image)
+
+                        def train_step():
+                                optimizer.zero_grad()
+                                output, _, _ = model(image)
+                                F.cross_entropy(output, target.long()).backward()
+                                optimizer.step()
+
+                        model.eval()
+                        infer_seconds = time_call(infer, iters=args.iters, warmup=args.warmup, device=args.device)
+                        model.train()
+                        train_seconds = time_call(train_step, iters=args.iters, warmup=args.warmup, device=args.device)
+                        rows.append([backbone,
+                                     'channels_last' if memory_format == torch.channels_last else 'nchw',
+                                     '%.2f' % (args.batch_size / infer_seconds),
+                                     '%.2f' % (args.batch_size / train_seconds)])
+        print_table(['backbone', 'format', 'infer img/s', 'train img/s'], rows)
+
+
+def bench_bf16(args):
+        """Throughput of fp32 vs bfloat16 autocast, and with --checkpoint the
+        mIoU/PDR difference on the LNF validation subset."""
+        device_type = torch.device(args.device).type
+        rows = []
+        for backbone in args.backbones:
+                model = build_model(args, backbone)
+                optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+                image, target = random_batch(args)
+                for bf16 in [False, True]:
+                        def infer():
+                                with torch.no_grad(), torch.autocast(device_type, dtype=torch.bfloat16, enabled=bf16):
+                                        model(image)
+
+                        def train_step():
+                                optimizer.zero_grad()
+                                with torch.autocast(device_type, dtype=torch.bfloat16, enabled=bf16):
+                                        output, _, _ = model(image)
+                                F.cross_entropy(output.float(), target.long()).backward()
+                                optimizer.step()
+
+                        model.eval()
+                        infer_seconds = time_call(infer, iters=args.iters, warmup=args.warmup, device=args.device)
+                        model.train()
+                        train_seconds = time_call(train_step, iters=args.iters, warmup=args.warmup, device=args.device)
+                        rows.append([backbone, 'bf16' if bf16 else 'fp32',
+                                     '%.2f' % (args.batch_size / infer_seconds),
+                                     '%.2f' % (args.batch_size / train_seconds)])
+        print_table(['backbone', 'dtype', 'infer img/s', 'train img/s'], rows)
+
+        if args.checkpoint is not None:
+                from inference.predictor import build_model as load_model
+                from inference.evaluate import evaluate, make_lnf_loader
+                from inference.export import prepare_for_export
+                model, config = load_model(args.checkpoint)
+                model = prepare_for_export(model)
+                loader = make_lnf_loader(args.dataset, config['depth'], 'test', args.val_frames, args.batch_size)
+                rows = []
+                for bf16 in [False, True]:
+                        metrics = evaluate(model, loader, config['num_classes'], autocast=bf16)
+                        rows.append(['bf16' if bf16 else 'fp32'] +
+                                    ['-' if metrics[k] is None else '%.4f' % metrics[k]
+                                     for k in ['mIoU', 'PDR', 'precision', 'IDR']])
+                print_table(['dtype', 'mIoU', 'PDR', 'precision', 'IDR'], rows)
+
+
+def bench_checkpoint(args):
+        """Activation memory and step time of a training step for each
+        activation checkpointing granularity."""
+        rows = []
+        for backbone in args.backbones:
+                if backbone not in ['drn', 'resnet']:
+                        continue
+                model = build_model(args, backbone)
+                model.train()
+                optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+                image, target = random_batch(args)
+
+                def step():
+                        optimizer.zero_grad()
+                        output, _, _ = model(image)
+                        F.cross_entropy(output, target.long()).backward()
+                        optimizer.step()
+
+                for granularity in GRANULARITIES:
+                        model.set_checkpointing(granularity)
+                        if args.device.startswith('cuda'):
+                                torch.cuda.empty_cache()
+                                torch.cuda.reset_peak_memory_stats()
+                        with SavedTensorMeter() as meter:
+                                step()
+                        peak = format_bytes(torch.cuda.max_memory_allocated()) if args.device.startswith('cuda') else '-'
+                        seconds = time_call(step, iters=args.iters, warmup=args.warmup, device=args.device)
+                        rows.append([backbone, granularity, '%.3f' % seconds, format_bytes(meter.nbytes), peak])
+        print_table(['backbone', 'checkpointing', 'step (s)', 'saved activations', 'cuda peak'], rows)
+
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import torch
+imported_torch = time.perf_counter()
+from modeling.deeplab import DeepLab
+imported = time.perf_counter()
+model = DeepLab(num_classes={num_classes}, backbone='{backbone}', sync_bn=False,
+                depth={depth}, pretrained={pretrained})
+ready = time.perf_counter()
+print(json.dumps({{'torch': imported_torch - start, 'import': imported - imported_torch,
+                  'build': ready - imported, 'total': ready - start,
+                  'modules': sorted(m for m in sys.modules if m.startswith('modeling.backbone.'))}}))
+'''
+
+
+def bench_startup(args):
+        """Time to model ready of a fresh process for each backbone, split into
+        the torch import, the modeling import and the model construction (with
+        --pretrained, including loading the weights from the local store)."""
+        rows = []
+        for backbone in args.backbones:
+                script = STARTUP_SCRIPT.format(num_classes=args.num_classes, backbone=backbone,
+                                               depth=args.depth, pretrained=args.pretrained)
+                out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+                if out.returncode != 0:
+                        rows.append([backbone, '-', '-', '-', '-', out.stderr.strip().splitlines()[-1]])
+                        continue
+                times = json.loads(out.stdout.strip().splitlines()[-1])
+                rows.append([backbone] + ['%.2f' % times[k] for k in ['torch', 'import', 'build', 'total']] +
+                            [' '.join(m.split('.')[-1] for m in times['modules'])])
+        print_table(['backbone', 'torch (s)', 'import (s)', 'build (s)', 'ready (s)', 'backbone modules'], rows)
+
+
+def bench_modules(args):
+        """Per-module inference time, FLOPs, parameters and output activation
+        memory of one configuration, as a table and optionally as JSON."""
+        model = build_model(args).eval()
+        height, width = args.input_size or (args.crop_size, args.crop_size)
+        image = torch.randn(args.batch_size, 4 if args.depth else 3, height, width, device=args.device)
+        rows = profile_modules(model, image, max_depth=args.module_depth, iters=args.iters,
+                               warmup=args.warmup, device=args.device)
+        total = rows[-1]['time_ms']
+        print_table(['module', 'calls', 'time (ms)', 'time (%)', 'GFLOPs', 'params (M)', 'activations'],
+                    [[r['name'], r['calls'], '%.2f' % r['time_ms'], '%.1f' % (100 * r['time_ms'] / total),
+                      '%.2f' % (r['flops'] / 1e9), '%.3f' % (r['params'] / 1e6), format_bytes(r['activation_bytes'])]
+                     for r in rows])
+        if args.json is not None:
+                config = {k: getattr(args, k) for k in ['backbone', 'out_stride', 'depth', 'aspp', 'batch_size',
+                                                        'device']}
+                config['input_size'] = [height, width]
+                with open(args.json, 'w') as f:
+                        json.dump({'config': config, 'modules': rows}, f, indent=2)
+
+
+def _sync_bn_worker(rank, args, port):
+        os.environ['MASTER_ADDR'], os.environ['MASTER_PORT'] = '127.0.0.1', str(port)
+        dist.init_process_group('gloo', rank=rank, world_size=args.world_size)
+        torch.set_num_threads(max(1, args.threads // args.world_size))
+        # the full batch of all ranks, every rank trains on its shard
+        batch_size = args.batch_size
+        args.batch_size = batch_size * args.world_size
+        torch.manual_seed(1)
+        image, target = random_batch(args)
+        shard = slice(rank * batch_size, (rank + 1) * batch_size)
+
+        def build(sync_bn):
+                torch.manual_seed(2)
+                model = build_model(args, sync_bn=sync_bn).train()
+                for m in model.modules():
+                        # dropout off, so that the outputs are comparable
+                        if isinstance(m, nn.Dropout):
+                                m.eval()
+                        # constant channels of a random model give BN outputs of exactly the
+                        # bias, 0 at init, where the (sub)gradient of the following ReLU depends
+                        # on rounding; random affine parameters keep them off the kink
+                        if isinstance(m, _BatchNorm):
+                                nn.init.uniform_(m.weight, 0.5, 1.5)
+                                nn.init.uniform_(m.bias, -0.5, 0.5)
+                return model
+
+        # parity: sync bn on the shards vs plain bn on the full batch
+        reference, model = build(False), build(True)
+        keys_match = list(reference.state_dict().keys()) == list(model.state_dict().keys())
+        output, _, _ = reference(image)
+        F.cross_entropy(output, target.long()).backward()
+        ddp = DistributedDataParallel(use_process_group(model))
+        sync_output, _, _ = ddp(image[shard])
+        F.cross_entropy(sync_output, target[shard].long()).backward()
+        grads = [(p.grad, q.grad) for p, q in zip(model.parameters(), reference.parameters()) if q.grad is not None]
+        errors = torch.tensor([(sync_output - output[shard]).abs().max().item() / output.abs().max().item(),
+                               (sum((g - h).pow(2).sum() for g, h in grads) /
+                                sum(h.pow(2).sum() for _, h in grads)).sqrt().item()])
+        dist.all_reduce(errors, op=dist.ReduceOp.MAX)
+        del reference, model, ddp, output, sync_output, grads
+
+        rows = []
+        for name, sync_bn in [('plain bn', False), ('sync bn', True)]:
+                model = build(sync_bn)
+                if sync_bn:
+                        use_process_group(model)
+                ddp = DistributedDataParallel(model)
+                optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+
+                def step():
+                        optimizer.zero_grad()
+                        output, _, _ = ddp(image[shard])
+                        F.cross_entropy(output, target[shard].long()).backward()
+                        optimizer.step()
+
+                seconds = torch.tensor(time_call(step, iters=args.iters, warmup=args.warmup))
+                dist.all_reduce(seconds, op=dist.ReduceOp.MAX)
+                rows.append([name, '%.3f' % seconds.item()])
+        layers = sum(isinstance(m, SynchronizedBatchNorm2d) for m in model.modules())
+        del model, ddp, optimizer
+        if rank == 0:
+                base = float(rows[0][1])
+                for row in rows:
+                        row.append('%+.1f%%' % (100 * (float(row[1]) - base) / base))
+                print('{} ranks (gloo), {} frames per rank, {} synchronized BN layers'.format(
+                        args.world_size, batch_size, layers))
+                print_table(['bn', 'step (s)', 'overhead'], rows)
+                print('sync bn vs full batch plain bn: max rel. output error {:.2e}, rel. gradient error {:.2e}, '
+                      'state dict keys {}'.format(errors[0].item(), errors[1].item(),
+                                                  'match' if keys_match else 'differ'))
+        dist.destroy_process_group()
+
+
+def bench_sync_bn(args):
+        """DistributedDataParallel training step with SynchronizedBatchNorm2d in
+        process group mode vs plain BN, over --world-size CPU ranks with gloo,
+        and the parity of sync BN against plain BN on the full batch."""
+        with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                port = s.getsockname()[1]
+        args.device = 'cpu'
+        args.threads = torch.get_num_threads()
+        mp.spawn(_sync_bn_worker, args=(args, port), nprocs=args.world_size)
+
+
+def bench_save(args):
+        """Training loop stall of Saver.save_checkpoint, writing in the loop vs
+        from the background writer, for the checkpoint of a model with its
+        SGD momentum state. 'written' is the time until the checkpoint and the
+        model_best link are on disk."""
+        model = build_model(args)
+        optimizer = torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9)
+        image, target = random_batch(args)
+        output, _, _ = model(image)
+        F.cross_entropy(output, target.long()).backward()
+        optimizer.step()
+        state = {'epoch': 1, 'state_dict': model.state_dict(), 'optimizer': optimizer.state_dict(), 'best_pred': 0.5}
+
+        # a fresh directory, so no earlier run has a better best_pred
+        save_dir = tempfile.mkdtemp(dir=args.save_dir)
+        os.chdir(save_dir)
+        rows = []
+        for name, max_pending in [('in loop', 0), ('background', 1)]:
+                saver = Saver(argparse.Namespace(debug=False, logsFlag='bench', dataset=args.dataset,
+                                                 checkname='{}-{}'.format(args.backbone, max_pending)),
+                              max_pending=max_pending)
+                stall = written = 0.0
+                for _ in range(args.iters):
+                        start = time.perf_counter()
+                        saver.save_checkpoint(state, True)
+                        stall += time.perf_counter() - start
+                        saver.wait()
+                        written += time.perf_counter() - start
+                saver.close()
+                checkpoint = os.path.join(saver.experiment_dir, 'checkpoint.pth.tar')
+                best = os.path.join(saver.experiment_dir, 'model_best.pth.tar')
+                rows.append([name, '%.3f' % (stall / args.iters), '%.3f' % (written / args.iters),
+                             format_bytes(os.path.getsize(checkpoint)),
+                             'hard link' if os.path.samefile(checkpoint, best) else 'copy'])
+        print('checkpoints in {}'.format(save_dir))
+        print_table(['save', 'stall (s)', 'written (s)', 'size', 'model_best'], rows)
+
+
+MODES = {
+        'loss-res': bench_loss_res,
+        'channels-last': bench_channels_last,
+        'bf16': bench_bf16,
+        'checkpoint': bench_checkpoint,
+        'startup': bench_startup,
+        'modules': bench_modules,
+        'sync-bn': bench_sync_bn,
+        'save': bench_save,
+}
+
+
+def main():
+        parser = argparse.ArgumentParser(description="DeepLab speed and memory benchmarks")
+        parser.add_argument('--mode', type=str, required=True, choices=sorted(MODES.keys()))
+        parser.add_argument('--backbone', type=str, default='drn',
+                            choices=['resnet', 'xception', 'drn', 'mobilenet'])
+        parser.add_argument('--backbones', type=str, nargs='+',
+                            default=['resnet', 'xception', 'drn', 'mobilenet'],
+                            help='backbones compared by the multi-backbone modes')
+        parser.add_argument('--out-stride', type=int, default=16)
+        parser.add_argument('--aspp', type=str, default='dense', choices=ASPP_TYPES)
+        parser.add_argument('--num-classes', type=int, default=3)
+        parser.add_argument('--depth', action='store_true', default=False)
+        parser.add_argument('--batch-size', type=int, default=2)
+        parser.add_argument('--crop-size', type=int, default=512)
+        parser.add_argument('--boundary-weight', type=float, default=0.1)
+        parser.add_argument('--iters', type=int, default=5)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--checkpoint', type=str, default=None,
+                            help='checkpoint for the accuracy comparison of the bf16 mode')
+        parser.add_argument('--dataset', type=str, default='lnf')
+        parser.add_argument('--val-frames', type=int, default=100,
+                            help='number of LNF test frames in the validation subset')
+        parser.add_argument('--pretrained', action='store_true', default=False,
+                            help='load the ImageNet weights from the local store in the startup mode')
+        parser.add_argument('--input-size', type=int, nargs=2, default=None, metavar=('H', 'W'),
+                            help='input size of the modules mode (default: crop size square)')
+        parser.add_argument('--module-depth', type=int, default=2,
+                            help='nesting depth of the modules reported by the modules mode')
+        parser.add_argument('--json', type=str, default=None,
+                            help='also write the modules mode report to this JSON file')
+        parser.add_argument('--world-size', type=int, default=2,
+                            help='number of gloo ranks of the sync-bn mode')
+        parser.add_argument('--save-dir', type=str, default=None,
+                            help='directory of the temporary directory the save mode writes to (default: the system one)')
+        parser.add_argument('--no-cuda', action='store_true', default=False)
+        args = parser.parse_args()
+        args.device = 'cuda' if not args.no_cuda and torch.cuda.is_available() else 'cpu'
+        torch.manual_seed(1)
+        MODES[args.mode](args)
+
+
+if __name__ == "__main__":
+        main()
@@ -23,8 +23,7 @@ class Normalize(object):
         img -= self.mean
         img /= self.std
 
-        return {'image': img,
-                'label': mask}
+        return dict(sample, image=img, label=mask)
 
 # normalize for the combined rgbd channels
 class NormalizeD(object):
@@ -46,8 +45,7 @@ class NormalizeD(object):
         img -= self.mean
         img /= self.std
 
-        return {'image': img,
-                'label': mask}
+        return dict(sample, image=img, label=mask)
 
 
 class ToTensor(object):
@@ -65,20 +63,20 @@ class ToTensor(object):
         img = torch.from_numpy(img).float()
         mask = torch.from_numpy(mask).float()
 
-        return {'image': img,
-                'label': mask}
+        return dict(sample, image=img, label=mask)
 
 
 class RandomHorizontalFlip(object):
     def __call__(self, sample):
         img = sample['image']
         mask = sample['label']
-        if random.random() < 0.5:
+        flip = random.random() < 0.5
+        if flip:
             img = img.transpose(Image.FLIP_LEFT_RIGHT)
             mask = mask.transpose(Image.FLIP_LEFT_RIGHT)
 
-        return {'image': img,
-                'label': mask}
+        # the flip and crop are recorded for the teacher cache (utils/distillation.py)
+        return dict(sample, image=img, label=mask, flip=flip)
 
 
 class RandomRotate(object):
@@ -156,8 +154,10 @@ class RandomCrop(object):
         h,w,_=img.shape
         #assert h == self.crop_size[0], "Input image height incorrect"
         crop_w=np.random.randint(0,w-self.crop_size[1])
-        return {'image': Image.fromarray(img[0:self.crop_size[0],crop_w:crop_w+self.crop_size[1],:3]),
-                'label': Image.fromarray(mask[0:self.crop_size[0],crop_w:crop_w+self.crop_size[1]])}
+        return dict(sample,
+                    image=Image.fromarray(img[0:self.crop_size[0],crop_w:crop_w+self.crop_size[1],:3]),
+                    label=Image.fromarray(mask[0:self.crop_size[0],crop_w:crop_w+self.crop_size[1]]),
+                    crop_w=crop_w)
 
 class FixScaleCrop(object):
     def __init__(self, crop_size):
@@ -0,0 +1,7 @@
+from .predictor import Predictor, build_model, infer_config, load_state_dict
+from .fold_bn import fold_batchnorm
+from .streaming import StreamingPredictor
+from .cascade import CascadePredictor
+from .server import DynamicBatcher
+from .tta import TestTimeAugmentation
+from .mc_dropout import MCDropoutPredictor, mc_dropout
@@ -0,0 +1,118 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+from inference.predictor import Predictor
+from inference.evaluate import evaluate, make_lnf_loader
+
+
+class CascadePredictor(Predictor):
+    """Coarse-to-fine inference for small obstacles.
+
+    The whole frame is run at scale times the input resolution. Tiles of
+    tile_size pixels where the coarse obstacle probability exceeds
+    prob_threshold, or the coarse confidence drops below conf_threshold,
+    are re-run at full resolution with margin pixels of context on each
+    side. Their outputs replace the upsampled coarse outputs.
+
+    Args:
+        scale: resolution of the coarse pass relative to the input
+        tile_size: size of the refined tiles at input resolution
+        margin: context around a tile, cropped off after the full res pass
+        prob_threshold: obstacle probability that marks a tile for refinement
+        conf_threshold: confidence below which a tile is refined
+        obstacle_class: class id of the small obstacles
+        tile_batch: number of tiles run in one batch
+        other arguments as for Predictor
+
+    tiles_refined and tiles_total count the tiles over all calls.
+    """
+    def __init__(self, checkpoint, scale=0.5, tile_size=256, margin=32, prob_threshold=0.3,
+                 conf_threshold=0.5, obstacle_class=2, tile_batch=8, **kwargs):
+        super(CascadePredictor, self).__init__(checkpoint, **kwargs)
+        self.scale = scale
+        self.tile_size = tile_size
+        self.margin = margin
+        self.prob_threshold = prob_threshold
+        self.conf_threshold = conf_threshold
+        self.obstacle_class = obstacle_class
+        self.tile_batch = tile_batch
+        self.tiles_refined = 0
+        self.tiles_total = 0
+
+    def select_tiles(self, prob, conf):
+        """(batch, top, left) of the tiles that need a full resolution pass."""
+        t = self.tile_size
+        prob_max = F.max_pool2d(prob, t, t, ceil_mode=True)
+        conf_min = -F.max_pool2d(-conf, t, t, ceil_mode=True)
+        mask = (prob_max > self.prob_threshold) | (conf_min < self.conf_threshold)
+        self.tiles_total += mask.numel()
+        return [(b, i * t, j * t) for b, _, i, j in mask.nonzero().tolist()]
+
+    def forward(self, image):
+        n, _, h, w = image.shape
+        coarse = F.interpolate(image, size=(int(h * self.scale), int(w * self.scale)),
+                               mode='bilinear', align_corners=True)
+        x, conf = self.model(coarse, resolution='fused')
+        x = F.interpolate(x, size=(h, w), mode='bilinear', align_corners=True)
+        conf = F.interpolate(conf, size=(h, w), mode='bilinear', align_corners=True)
+        prob = F.softmax(x, dim=1)[:, self.obstacle_class:self.obstacle_class + 1]
+
+        tiles = self.select_tiles(prob, conf)
+        self.tiles_refined += len(tiles)
+        # every window has the same size so that tiles can be batched, windows
+        # at the frame border are shifted inwards
+        win_h, win_w = min(self.tile_size + 2 * self.margin, h), min(self.tile_size + 2 * self.margin, w)
+        for k in range(0, len(tiles), self.tile_batch):
+            windows = []
+            for b, top, left in tiles[k:k + self.tile_batch]:
+                y0 = min(max(top - self.margin, 0), h - win_h)
+                x0 = min(max(left - self.margin, 0), w - win_w)
+                windows.append((b, top, left, y0, x0))
+            batch = torch.stack([image[b, :, y0:y0 + win_h, x0:x0 + win_w] for b, _, _, y0, x0 in windows])
+            tile_x, tile_conf = self.model(batch, resolution='fused')
+            for i, (b, top, left, y0, x0) in enumerate(windows):
+                bottom, right = min(top + self.tile_size, h), min(left + self.tile_size, w)
+                x[b, :, top:bottom, left:right] = tile_x[i, :, top - y0:bottom - y0, left - x0:right - x0]
+                conf[b, :, top:bottom, left:right] = tile_conf[i, :, top - y0:bottom - y0, left - x0:right - x0]
+        return x, conf
+
+
+if __name__ == "__main__":
+    # throughput and small obstacle recall of the cascade against full
+    # resolution inference, for a range of thresholds
+    parser = argparse.ArgumentParser(description="Coarse-to-fine cascade inference report")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--dataset', type=str, default='lnf')
+    parser.add_argument('--eval-frames', type=int, default=None,
+                        help='number of test frames used for the report (default: all)')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--margin', type=int, default=32)
+    parser.add_argument('--prob-thresholds', type=float, nargs='+', default=[0.1, 0.3, 0.5])
+    parser.add_argument('--conf-threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    full = Predictor(args.checkpoint, device=device)
+    loader = make_lnf_loader(args.dataset, full.config['depth'], 'test', args.eval_frames, args.batch_size)
+    num_class = full.config['num_classes']
+
+    def report(name, predictor, tiles=None):
+        start = time.perf_counter()
+        metrics = evaluate(lambda image: [out.cpu() for out in predictor.forward(image.to(device))],
+                           loader, num_class)
+        fps = len(loader.dataset) / (time.perf_counter() - start)
+        print('{:<20} {:>8.2f} {:>8.4f} {:>8} {:>10}'.format(
+            name, fps, metrics['mIoU'], '-' if metrics['PDR'] is None else '%.4f' % metrics['PDR'],
+            '-' if tiles is None else '%.1f%%' % (100.0 * tiles())))
+
+    print('{:<20} {:>8} {:>8} {:>8} {:>10}'.format('mode', 'frames/s', 'mIoU', 'PDR', 'refined'))
+    report('full resolution', full)
+    for prob_threshold in args.prob_thresholds:
+        cascade = CascadePredictor(args.checkpoint, scale=args.scale, tile_size=args.tile_size,
+                                   margin=args.margin, prob_threshold=prob_threshold,
+                                   conf_threshold=args.conf_threshold, device=device)
+        report('cascade p>{:g}'.format(prob_threshold), cascade,
+               lambda: cascade.tiles_refined / max(cascade.tiles_total, 1))
@@ -0,0 +1,44 @@
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from mypath import Path
+from utils.metrics import Evaluator
+import utils.helpers as HLP
+
+
+def evaluate(model, loader, num_class, class_id=2, autocast=False):
+    """mIoU, PDR, precision and IDR of a model returning (x, conf, ...) on a loader.
+
+    With autocast the forward runs in bfloat16 on CPU, while the argmax and
+    the Evaluator metrics stay in fp32.
+    """
+    evaluator = Evaluator(num_class)
+    evaluator.reset()
+    with torch.no_grad():
+        for sample in tqdm(loader, desc='evaluation'):
+            with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=autocast):
+                output = model(sample['image'])[0]
+            pred = output.float().argmax(dim=1).numpy()
+            evaluator.add_batch(sample['label'].numpy(), pred)
+    recall, precision = evaluator.pdr_metric(class_id=class_id)
+    return {'mIoU': evaluator.Mean_Intersection_over_Union(),
+            'PDR': recall,
+            'precision': precision,
+            'IDR': evaluator.idr_metric(class_id=class_id)}
+
+
+def make_lnf_loader(dataset, depth, data_type, num_samples, batch_size, shuffle=False):
+    """Full frame LNF loader (deterministic test transforms) for a data split."""
+    if depth:
+        imgs, disp, labels = HLP.get_ImagesAndLabels_mergenet(Path.db_root_dir(dataset),
+                                                            data_type=data_type,
+                                                            num_samples=num_samples)
+        generator = HLP.LNFGeneratorTorch(rgb_path=imgs, disparity_path=disp, mask_path=labels,
+                                          flag='merge', split='test')
+    else:
+        imgs, labels = HLP.get_ImagesAndLabels_contextnet(Path.db_root_dir(dataset),
+                                                          data_type=data_type,
+                                                          num_samples=num_samples)
+        generator = HLP.LNFGeneratorTorch(rgb_path=imgs, mask_path=labels,
+                                          flag='context', split='test')
+    return DataLoader(generator, batch_size=batch_size, shuffle=shuffle)
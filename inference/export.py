@@ -0,0 +1,171 @@
+import argparse
+import copy
+import os
+import torch
+import torch.nn as nn
+from modeling.deeplab import DeepLab
+from modeling.sync_batchnorm import revert_sync_batchnorm
+from inference.predictor import build_model
+from utils.profiling import time_call
+
+BACKBONES = ['resnet', 'xception', 'drn', 'mobilenet']
+
+
+class ExportWrapper(nn.Module):
+    """DeepLab returning only the (x, conf) outputs used at inference."""
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input):
+        x, conf = self.model(input, resolution='fused')
+        return x, conf
+
+
+def prepare_for_export(model):
+    """Eval mode wrapper with SynchronizedBatchNorm2d replaced by nn.BatchNorm2d."""
+    model = revert_sync_batchnorm(model)
+    return ExportWrapper(model).eval()
+
+
+def export_torchscript(model, example, path):
+    with torch.no_grad():
+        module = torch.jit.trace(model, example)
+        module = torch.jit.freeze(module)
+    torch.jit.save(module, path)
+    return torch.jit.load(path)
+
+
+def export_onnx(model, example, path, opset=17):
+    with torch.no_grad():
+        torch.onnx.export(model, (example,), path,
+                          input_names=['input'], output_names=['x', 'conf'],
+                          dynamic_axes={'input': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'x': {0: 'batch', 2: 'height', 3: 'width'},
+                                        'conf': {0: 'batch', 2: 'height', 3: 'width'}},
+                          opset_version=opset, dynamo=False)
+    try:
+        import onnx
+        onnx.checker.check_model(onnx.load(path))
+    except ImportError:
+        pass
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return lambda input: [torch.from_numpy(o) for o in session.run(None, {'input': input.numpy()})]
+
+
+def max_relative_error(reference, outputs):
+    """Largest error over both outputs, relative to the output magnitude."""
+    error = 0.0
+    for ref, out in zip(reference, outputs):
+        scale = max(ref.abs().max().item(), 1.0)
+        error = max(error, (ref - out).abs().max().item() / scale)
+    return error
+
+
+def export(model, channels, out_dir, name, size, batch_size=1, iters=10):
+    """Exports model to TorchScript and ONNX and checks both for parity.
+
+    All backends, eager fp32 included, are compared against an fp64 eager
+    reference. Returns rows of (backend, latency in ms per batch, max
+    relative error).
+    """
+    model = prepare_for_export(model)
+    reference_model = copy.deepcopy(model).double()
+    example = torch.randn(batch_size, channels, size[0], size[1])
+    # a second shape checks that the exported graphs are not specialised to the example
+    inputs = [example, torch.randn(batch_size + 1, channels, size[0] // 2 + 8, size[1] // 2 + 16)]
+
+    def parity(fn):
+        return max(max_relative_error([r.float() for r in reference_model(input.double())], fn(input))
+                   for input in inputs)
+
+    with torch.no_grad():
+        rows = [('eager', time_call(lambda: model(example), iters=iters) * 1000, parity(model))]
+
+        scripted = export_torchscript(model, example, os.path.join(out_dir, name + '.pt'))
+        rows.append(('torchscript', time_call(lambda: scripted(example), iters=iters) * 1000, parity(scripted)))
+
+        session = export_onnx(model, example, os.path.join(out_dir, name + '.onnx'))
+        if session is not None:
+            rows.append(('onnxruntime', time_call(lambda: session(example), iters=iters) * 1000, parity(session)))
+    return rows
+
+
+def calibrate_batchnorm(model, channels, size):
+    """Sets BN running statistics of a randomly initialised model from one random
+    batch, so that activations keep a realistic scale through deep backbones."""
+    bns = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momentums = [m.momentum for m in bns]
+    for m in bns:
+        m.momentum = 1.0
+    model.train()
+    with torch.no_grad():
+        model(torch.randn(2, channels, size[0], size[1]))
+    for m, momentum in zip(bns, momentums):
+        m.momentum = momentum
+    return model.eval()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export DeepLab to TorchScript and ONNX")
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='checkpoint to export, random weights if not given')
+    parser.add_argument('--backbone', type=str, default='drn', choices=BACKBONES)
+    parser.add_argument('--depth', action='store_true', default=False)
+    parser.add_argument('--num-classes', type=int, default=3)
+    parser.add_argument('--out-stride', type=int, default=16)
+    parser.add_argument('--input-size', type=int, nargs=2, default=[512, 512])
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--tol', type=float, default=1e-4,
+                        help='maximum error against an fp64 reference, relative to the \
+                        output magnitude (or 10x the eager fp32 error if larger)')
+    parser.add_argument('--out-dir', type=str, default='./exports')
+    parser.add_argument('--check-all', action='store_true', default=False,
+                        help='export randomly initialised models of every backbone, \
+                        RGB and RGB-D, with sync bn, and check parity')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    if args.check_all and args.checkpoint is None:
+        configs = [(backbone, depth) for backbone in BACKBONES for depth in [False, True]]
+    else:
+        configs = [(args.backbone, args.depth)]
+
+    results = []
+    for backbone, depth in configs:
+        if args.checkpoint is not None:
+            model, config = build_model(args.checkpoint, args.out_stride)
+            backbone, depth = config['backbone'], config['depth']
+        else:
+            # sync bn so that the SynchronizedBatchNorm2d conversion is exercised
+            model = DeepLab(num_classes=args.num_classes, backbone=backbone,
+                            output_stride=args.out_stride, sync_bn=True,
+                            depth=depth, pretrained=False)
+        name = 'deeplab-{}-{}'.format(backbone, 'rgbd' if depth else 'rgb')
+        if args.checkpoint is None:
+            calibrate_batchnorm(model, 4 if depth else 3, args.input_size)
+        rows = export(model, 4 if depth else 3, args.out_dir, name,
+                      args.input_size, args.batch_size, args.iters)
+        results.extend((name,) + row for row in rows)
+
+    print('{:<24} {:<12} {:>14} {:>12}'.format('model', 'backend', 'latency (ms)', 'max error'))
+    failed = False
+    for name, backend, latency, error in results:
+        # exported graphs may round differently, but not much worse than eager fp32 itself
+        eager_error = [r[3] for r in results if r[0] == name and r[1] == 'eager'][0]
+        status = '' if error <= max(args.tol, 10 * eager_error) else '  PARITY FAILED'
+        failed = failed or bool(status)
+        print('{:<24} {:<12} {:>14.2f} {:>12.2e}{}'.format(name, backend, latency, error, status))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import copy
+import itertools
+import torch
+import torch.nn as nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from modeling.deeplab import DeepLab
+from modeling.aspp import ASPP_TYPES
+from modeling.backbone.xception import SeparableConv2d
+
+# (conv, bn) attribute pairs where the bn is applied directly to the conv output:
+# drn/resnet BasicBlock and Bottleneck, DRN-C/ResNet/Xception stems, Xception
+# exit flow and skip branch, SeparableConv2d, _ASPPModule, ASPP and Decoder.
+FOLD_PAIRS = [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3'), ('conv4', 'bn4'),
+              ('conv5', 'bn5'), ('conv1', 'bn'), ('atrous_conv', 'bn'), ('skip', 'skipbn')]
+
+
+def _fold(conv, bn):
+    """Returns conv with bn folded in; for a SeparableConv2d the bn is folded
+    into its pointwise conv, which is the last op of the block."""
+    if isinstance(conv, SeparableConv2d):
+        conv.pointwise = fuse_conv_bn_eval(conv.pointwise, bn)
+        return conv
+    return fuse_conv_bn_eval(conv, bn)
+
+
+def _foldable(conv, bn):
+    return isinstance(conv, (nn.Conv2d, SeparableConv2d)) and isinstance(bn, _BatchNorm)
+
+
+def fold_batchnorm(model):
+    """Folds every BatchNorm (or SynchronizedBatchNorm2d) that directly follows a
+    conv into the conv weight and bias, and replaces the BN by nn.Identity.
+
+    Works in place on an eval mode model and returns it. Covers all backbones,
+    the downsample branches, ASPP and the decoder.
+    """
+    assert not model.training, 'batchnorm can only be folded in eval mode'
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                if _foldable(module[i], module[i + 1]):
+                    module[i] = _fold(module[i], module[i + 1])
+                    module[i + 1] = nn.Identity()
+        for conv_name, bn_name in FOLD_PAIRS:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if _foldable(conv, bn):
+                setattr(module, conv_name, _fold(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+    return model
+
+
+if __name__ == "__main__":
+    # parity check: folded vs unfolded outputs for every backbone and input type,
+    # in fp64 so that fp32 rounding over deep backbones does not hide folding errors
+    from inference.export import calibrate_batchnorm, max_relative_error
+    parser = argparse.ArgumentParser(description="Conv-BN folding parity check")
+    parser.add_argument('--input-size', type=int, nargs=2, default=[128, 128])
+    parser.add_argument('--tol', type=float, default=1e-8)
+    args = parser.parse_args()
+
+    failed = False
+    for backbone, depth, aspp in itertools.product(['resnet', 'xception', 'drn', 'mobilenet'],
+                                               [False, True], ASPP_TYPES):
+        model = DeepLab(num_classes=3, backbone=backbone, sync_bn=True,
+                        depth=depth, pretrained=False, aspp=aspp)
+        channels = 4 if depth else 3
+        calibrate_batchnorm(model, channels, args.input_size)
+        model = model.double()
+        folded = fold_batchnorm(copy.deepcopy(model))
+        remaining = sum(isinstance(m, _BatchNorm) for m in folded.modules())
+        input = torch.randn(2, channels, args.input_size[0], args.input_size[1], dtype=torch.float64)
+        with torch.no_grad():
+            error = max_relative_error(model(input), folded(input))
+        ok = remaining == 0 and error <= args.tol
+        failed = failed or not ok
+        print('{:<10} {:<5} {:<10} remaining bn: {:<3} max error: {:.2e} {}'.format(
+            backbone, 'rgbd' if depth else 'rgb', aspp, remaining, error, 'ok' if ok else 'FAILED'))
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,141 @@
+import argparse
+import contextlib
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from inference.predictor import Predictor, build_model
+from inference.evaluate import make_lnf_loader
+
+
+@contextlib.contextmanager
+def dropout_active(module):
+    """Puts only the dropout layers of an eval mode module in training mode."""
+    dropouts = [m for m in module.modules() if isinstance(m, nn.modules.dropout._DropoutNd)]
+    modes = [m.training for m in dropouts]
+    for m in dropouts:
+        m.train()
+    try:
+        yield
+    finally:
+        for m, mode in zip(dropouts, modes):
+            m.train(mode)
+
+
+def mc_dropout(model, image, samples=8, chunk=None):
+    """MC-dropout estimate of an eval mode DeepLab that runs the backbone once.
+
+    The dropout layers are the ASPP output dropout and the two in
+    Decoder.last_conv, so the backbone and the ASPP up to its dropout are
+    computed once. The rest of the head runs for all samples as one batch
+    (or chunks of chunk samples), with dropout active.
+
+    Returns the mean gated logits, the sigmoid of the mean confidence logit
+    and the per-pixel variance of the class probabilities (averaged over
+    classes), at input resolution.
+    """
+    assert not model.training, 'mc_dropout expects an eval mode model'
+    chunk = chunk or samples
+    n = image.size(0)
+    features, low_level_feat = model.backbone(image)
+    # in eval mode the ASPP dropout is the identity
+    features = model.aspp(features)
+
+    x_sum = conf_sum = prob_sum = prob_sq_sum = 0
+    with dropout_active(model):
+        for start in range(0, samples, chunk):
+            k = min(chunk, samples - start)
+            x, conf = model.decoder(model.aspp.dropout(features.repeat(k, 1, 1, 1)),
+                                    low_level_feat.repeat(k, 1, 1, 1))
+            x, _, _ = model.gate_and_upsample(x, conf, image.size()[2:], 'decoder')
+            prob = F.softmax(x, dim=1)
+            x_sum = x_sum + x.view(k, n, *x.shape[1:]).sum(0)
+            conf_sum = conf_sum + conf.view(k, n, *conf.shape[1:]).sum(0)
+            prob_sum = prob_sum + prob.view(k, n, *prob.shape[1:]).sum(0)
+            prob_sq_sum = prob_sq_sum + (prob * prob).view(k, n, *prob.shape[1:]).sum(0)
+
+    mean_prob = prob_sum / samples
+    variance = (prob_sq_sum / samples - mean_prob * mean_prob).clamp(min=0).mean(1, keepdim=True)
+    # one upsampling of the three maps, as DeepLab(resolution='fused')
+    maps = torch.cat((x_sum / samples, conf_sum / samples, variance), dim=1)
+    maps = F.interpolate(maps, size=image.size()[2:], mode='bilinear', align_corners=True)
+    x, conf, variance = torch.split(maps, [x_sum.size(1), 1, 1], dim=1)
+    return x, torch.sigmoid(conf), variance
+
+
+class MCDropoutPredictor(Predictor):
+    """Predictor that also returns the MC-dropout variance.
+
+    Args:
+        samples: number of dropout samples
+        chunk: samples per batched head forward (default: all)
+        other arguments as for Predictor
+
+    predict() returns the class map of the mean logits, the mean confidence
+    and the variance map, all (N, h, w).
+    """
+    def __init__(self, checkpoint, samples=8, chunk=None, **kwargs):
+        super(MCDropoutPredictor, self).__init__(checkpoint, **kwargs)
+        self.samples = samples
+        self.chunk = chunk
+        self._variance = None
+
+    def forward(self, image):
+        x, conf, self._variance = mc_dropout(self.model, image, self.samples, self.chunk)
+        return x, conf
+
+    @torch.inference_mode()
+    def predict(self, frames):
+        classes, conf = super(MCDropoutPredictor, self).predict(frames)
+        variance = self._buffer('variance', classes.shape, torch.float32)
+        variance.copy_(self._variance[:, 0])
+        return classes, conf, variance
+
+    __call__ = predict
+
+
+if __name__ == "__main__":
+    # batched head sampling vs N full forward passes with dropout active
+    parser = argparse.ArgumentParser(description="MC-dropout uncertainty with a shared backbone pass")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--dataset', type=str, default='lnf')
+    parser.add_argument('--eval-frames', type=int, default=2)
+    parser.add_argument('--samples', type=int, default=8)
+    parser.add_argument('--chunk', type=int, default=None)
+    args = parser.parse_args()
+
+    model, config = build_model(args.checkpoint)
+    loader = make_lnf_loader(args.dataset, config['depth'], 'test', args.eval_frames, 1)
+
+    def full_passes(image):
+        probs, xs = [], []
+        with dropout_active(model):
+            for _ in range(args.samples):
+                x, _ = model(image, resolution='fused')
+                xs.append(x)
+                probs.append(F.softmax(x, dim=1))
+        probs = torch.stack(probs)
+        return torch.stack(xs).mean(0), probs.var(0, unbiased=False).mean(1, keepdim=True)
+
+    shared_time = full_time = 0.0
+    agreement, correlation, levels = [], [], []
+    with torch.no_grad():
+        for sample in loader:
+            image = sample['image']
+            start = time.perf_counter()
+            x, _, variance = mc_dropout(model, image, args.samples, args.chunk)
+            shared_time += time.perf_counter() - start
+            start = time.perf_counter()
+            x_full, variance_full = full_passes(image)
+            full_time += time.perf_counter() - start
+            agreement.append((x.argmax(1) == x_full.argmax(1)).float().mean().item())
+            correlation.append(np.corrcoef(variance.flatten().numpy(), variance_full.flatten().numpy())[0, 1])
+            levels.append((variance.mean().item(), variance_full.mean().item()))
+
+    frames = len(loader.dataset)
+    print('{} samples: shared backbone {:.2f} s/frame, full passes {:.2f} s/frame ({:.1f}x)'.format(
+        args.samples, shared_time / frames, full_time / frames, full_time / shared_time))
+    print('mean class map agreement {:.4f}, variance correlation {:.4f}'.format(
+        np.mean(agreement), np.mean(correlation)))
+    print('mean variance: shared backbone {:.5f}, full passes {:.5f}'.format(*np.mean(levels, axis=0)))
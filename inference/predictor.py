@@ -0,0 +1,162 @@
+import argparse
+import numpy as np
+import torch
+from modeling.deeplab import DeepLab, infer_widths
+from inference.fold_bn import fold_batchnorm
+
+# LNF frames are cropped to the road region and normalized exactly as in
+# utils.helpers.LNFGeneratorTorch (transform_ts / transform_ts_depth)
+CROP_ROWS = (281, 793)
+CROP_COLS = (128, 1920)
+RGB_MEAN = (0.485, 0.456, 0.406)
+RGB_STD = (0.229, 0.224, 0.225)
+RGBD_MEAN = (0.433, 0.469, 0.408, 0.139)
+RGBD_STD = (0.187, 0.185, 0.178, 0.087)
+
+
+def load_state_dict(checkpoint):
+    """Returns the model state dict of a checkpoint path or loaded checkpoint.
+
+    Accepts the dicts written by Saver ('state_dict' key) as well as bare
+    state dicts, with or without the DataParallel 'module.' prefix.
+    """
+    if isinstance(checkpoint, str):
+        checkpoint = torch.load(checkpoint, map_location='cpu')
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    return {k[len('module.'):] if k.startswith('module.') else k: v
+            for k, v in state_dict.items()}
+
+
+def infer_config(state_dict):
+    """Infers backbone, depth input, number of classes, ASPP type and
+    ASPP/decoder widths from a state dict."""
+    if 'backbone.layer0.0.weight' in state_dict:
+        backbone, stem = 'drn', 'backbone.layer0.0.weight'
+    elif 'backbone.features.0.0.weight' in state_dict:
+        backbone, stem = 'mobilenet', 'backbone.features.0.0.weight'
+    elif 'backbone.block1.skip.weight' in state_dict:
+        backbone, stem = 'xception', 'backbone.conv1.weight'
+    elif 'backbone.layer4.0.conv1.weight' in state_dict:
+        backbone, stem = 'resnet', 'backbone.conv1.weight'
+    else:
+        raise NotImplementedError('Unknown backbone in checkpoint')
+
+    return {'backbone': backbone,
+            'depth': state_dict[stem].shape[1] == 4,
+            'num_classes': state_dict['decoder.diverge_conv_pred.weight'].shape[0],
+            'aspp': 'separable' if 'aspp.aspp2.atrous_conv.pointwise.weight' in state_dict else 'dense',
+            'widths': infer_widths(state_dict)}
+
+
+def build_model(checkpoint, output_stride=16, device='cpu'):
+    """Builds an eval mode DeepLab from a checkpoint, without pretrained downloads."""
+    state_dict = load_state_dict(checkpoint)
+    config = infer_config(state_dict)
+    model = DeepLab(num_classes=config['num_classes'],
+                    backbone=config['backbone'],
+                    output_stride=output_stride,
+                    sync_bn=False,
+                    depth=config['depth'],
+                    pretrained=False,
+                    widths=config['widths'],
+                    aspp=config['aspp'])
+    model.load_state_dict(state_dict)
+    return model.to(device).eval(), config
+
+
+class Predictor(object):
+    """Batched inference on raw LNF frames.
+
+    Args:
+        checkpoint: path to a checkpoint written by train.py, or its dict
+        output_stride: output stride of resnet/xception/mobilenet models
+        device: torch device to run on
+        crop: apply the LNF road crop to full size frames
+        fold_bn: fold BatchNorm layers into the preceding convs
+        channels_last: run the model and the input buffer in NHWC memory format
+        autocast: run the forward in bfloat16 autocast, outputs are returned in fp32
+
+    predict() takes uint8 frames of shape (N, H, W, 3) for RGB models or
+    (N, H, W, 4) for RGB-D models (disparity already scaled to 8 bit as in
+    the data loader) and returns the class map (N, h, w) and the confidence
+    map (N, h, w). The returned tensors are views into buffers that are
+    reused by the next call; clone them to keep results around.
+    """
+    def __init__(self, checkpoint, output_stride=16, device='cpu', crop=True, fold_bn=True,
+                 channels_last=False, autocast=False):
+        self.device = torch.device(device)
+        self.autocast = autocast
+        self.model, self.config = build_model(checkpoint, output_stride, self.device)
+        if fold_bn:
+            fold_batchnorm(self.model)
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model = self.model.set_memory_format(self.memory_format)
+        self.crop = crop
+        self.channels = 4 if self.config['depth'] else 3
+        mean, std = (RGBD_MEAN, RGBD_STD) if self.config['depth'] else (RGB_MEAN, RGB_STD)
+        # Normalize/NormalizeD divide by 255 first, fold that into the constants
+        self._mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1) * 255.0
+        self._std = torch.tensor(std, device=self.device).view(1, -1, 1, 1) * 255.0
+        self._buffers = {}
+
+    def _buffer(self, name, shape, dtype, memory_format=torch.contiguous_format):
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape[1:] != shape[1:] or buf.shape[0] < shape[0]:
+            buf = torch.empty(shape, dtype=dtype, device=self.device, memory_format=memory_format)
+            self._buffers[name] = buf
+        return buf[:shape[0]]
+
+    def preprocess(self, frames):
+        if isinstance(frames, np.ndarray):
+            frames = torch.from_numpy(np.ascontiguousarray(frames))
+        if frames.dim() == 3:
+            frames = frames.unsqueeze(0)
+        if frames.shape[-1] != self.channels:
+            raise ValueError('Expected {} channel frames, got shape {}'.format(
+                self.channels, tuple(frames.shape)))
+        if self.crop and frames.shape[1] >= CROP_ROWS[1] and frames.shape[2] >= CROP_COLS[1]:
+            frames = frames[:, CROP_ROWS[0]:CROP_ROWS[1], CROP_COLS[0]:CROP_COLS[1]]
+
+        n, h, w, c = frames.shape
+        image = self._buffer('image', (n, c, h, w), torch.float32, self.memory_format)
+        image.copy_(frames.permute(0, 3, 1, 2))
+        image.sub_(self._mean).div_(self._std)
+        return image
+
+    def forward(self, image):
+        return self.model(image, resolution='fused')
+
+    @torch.inference_mode()
+    def predict(self, frames):
+        image = self.preprocess(frames)
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.autocast):
+            x, conf = self.forward(image)
+
+        n, _, h, w = x.shape
+        classes = self._buffer('classes', (n, h, w), torch.int64)
+        confidence = self._buffer('conf', (n, h, w), torch.float32)
+        torch.argmax(x, dim=1, out=classes)
+        confidence.copy_(conf[:, 0])
+        return classes, confidence
+
+    __call__ = predict
+
+
+if __name__ == "__main__":
+    from PIL import Image
+    parser = argparse.ArgumentParser(description="Run a DeepLab checkpoint on LNF frames")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--image', type=str, required=True)
+    parser.add_argument('--disparity', type=str, default=None,
+                        help='16 bit disparity png for RGB-D checkpoints')
+    parser.add_argument('--out', type=str, default='prediction.png')
+    args = parser.parse_args()
+
+    predictor = Predictor(args.checkpoint, device='cuda' if torch.cuda.is_available() else 'cpu')
+    frame = np.asarray(Image.open(args.image).convert('RGB'))
+    if args.disparity is not None:
+        disparity = np.rint(np.asarray(Image.open(args.disparity)) / 256).astype(np.uint8)
+        frame = np.concatenate((frame, disparity[:, :, None]), axis=2)
+    classes, conf = predictor(frame)
+    Image.fromarray(classes[0].cpu().numpy().astype(np.uint8)).save(args.out)
+    print('mean confidence: {:.3f}'.format(conf.mean().item()))
@@ -0,0 +1,177 @@
+import argparse
+import itertools
+import numpy as np
+import torch
+from tqdm import tqdm
+from modeling.deeplab import DeepLab, infer_widths
+from inference.predictor import build_model, load_state_dict
+from inference.evaluate import evaluate, make_lnf_loader
+from inference.export import prepare_for_export
+from utils.loss import SegmentationLosses
+from utils.calculate_weights import calculate_weights_batch
+from utils.profiling import count_flops, time_call
+
+# prunable channel groups: (conv producing the channels, its BN, consumers).
+# A consumer is (conv, bn or bias following it, groups concatenated at its input)
+ASPP_BRANCHES = ['aspp.aspp1.atrous_conv', 'aspp.aspp2.atrous_conv', 'aspp.aspp3.atrous_conv',
+                 'aspp.aspp4.atrous_conv', 'aspp.global_avg_pool.1']
+GROUPS = {
+    'aspp.aspp1.atrous_conv': 'aspp.aspp1.bn',
+    'aspp.aspp2.atrous_conv': 'aspp.aspp2.bn',
+    'aspp.aspp3.atrous_conv': 'aspp.aspp3.bn',
+    'aspp.aspp4.atrous_conv': 'aspp.aspp4.bn',
+    'aspp.global_avg_pool.1': 'aspp.global_avg_pool.2',
+    'aspp.conv1': 'aspp.bn1',
+    'decoder.conv1': 'decoder.bn1',
+    'decoder.last_conv.0': 'decoder.last_conv.1',
+    'decoder.last_conv.4': 'decoder.last_conv.5',
+}
+CONSUMERS = [
+    ('aspp.conv1', 'aspp.bn1', ASPP_BRANCHES),
+    ('decoder.last_conv.0', 'decoder.last_conv.1', ['aspp.conv1', 'decoder.conv1']),
+    ('decoder.last_conv.4', 'decoder.last_conv.5', ['decoder.last_conv.0']),
+    ('decoder.diverge_conv_pred', None, ['decoder.last_conv.4']),
+    ('decoder.diverge_conv_conf', None, ['decoder.last_conv.4']),
+]
+BN_KEYS = ['weight', 'bias', 'running_mean', 'running_var']
+
+
+def keep_channels(gamma, keep, multiple):
+    """Indices of the channels with the largest |gamma|, keep times the width
+    rounded to a multiple."""
+    n = max(multiple, int(round(keep * gamma.numel() / multiple)) * multiple)
+    n = min(n, gamma.numel())
+    return gamma.abs().argsort(descending=True)[:n].sort()[0]
+
+
+def prune_state_dict(state_dict, keep=0.5, multiple=8):
+    """Structured pruning of the ASPP and decoder channels of a DeepLab state dict.
+
+    In every group the channels with the smallest BN gamma are removed from
+    the producing conv and BN and from the input of the consuming convs. A
+    removed channel is approximated by its constant output relu(beta), whose
+    contribution is folded into the running mean of the BN after the
+    consumer, or into its bias. Returns the pruned state dict, loadable by
+    DeepLab(widths=infer_widths(state_dict)).
+    """
+    state_dict = dict(state_dict)
+    kept = {conv: keep_channels(state_dict[bn + '.weight'], keep, multiple) for conv, bn in GROUPS.items()}
+    # in a separable ASPP branch the channels are produced by its pointwise conv
+    producer = {conv: conv if conv + '.weight' in state_dict else conv + '.pointwise' for conv in GROUPS}
+
+    for conv, after, inputs in CONSUMERS:
+        weight = state_dict[conv + '.weight']
+        columns, offset, delta = [], 0, torch.zeros(weight.shape[0])
+        for name in inputs:
+            width = state_dict[producer[name] + '.weight'].shape[0]
+            removed = torch.ones(width, dtype=torch.bool)
+            removed[kept[name]] = False
+            constant = torch.relu(state_dict[GROUPS[name] + '.bias'])[removed]
+            delta += (weight[:, offset:offset + width][:, removed].sum((2, 3)) * constant).sum(1)
+            columns.append(kept[name] + offset)
+            offset += width
+        state_dict[conv + '.weight'] = weight[:, torch.cat(columns)]
+        if after is not None:
+            state_dict[after + '.running_mean'] = state_dict[after + '.running_mean'] - delta
+        else:
+            state_dict[conv + '.bias'] = state_dict[conv + '.bias'] + delta
+
+    for conv, bn in GROUPS.items():
+        state_dict[producer[conv] + '.weight'] = state_dict[producer[conv] + '.weight'][kept[conv]]
+        for key in BN_KEYS:
+            state_dict[bn + '.' + key] = state_dict[bn + '.' + key][kept[conv]]
+    return state_dict
+
+
+def finetune(model, loader, num_class, iters, lr, backbone=False):
+    """Short fine-tune of a pruned model, of the ASPP and decoder only unless backbone."""
+    criterion = SegmentationLosses(cuda=False)
+    params = model.parameters() if backbone else itertools.chain(model.aspp.parameters(),
+                                                                  model.decoder.parameters())
+    optimizer = torch.optim.SGD(params, lr=lr, momentum=0.9, weight_decay=5e-4)
+    model.train()
+    if not backbone:
+        model.backbone.eval()
+        for p in model.backbone.parameters():
+            p.requires_grad = False
+    batches = itertools.islice((sample for _ in itertools.count() for sample in loader), iters)
+    for sample in tqdm(batches, total=iters, desc='fine-tune'):
+        weight = torch.from_numpy(calculate_weights_batch(sample, num_class).astype(np.float32))
+        output, _, _ = model(sample['image'])
+        loss = criterion.CrossEntropyLoss(output, sample['label'], weight=weight)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    for p in model.parameters():
+        p.requires_grad = True
+    return model.eval()
+
+
+def report(name, model, example, loader, num_class, iters=5):
+    """(name, head GFLOPs, total GFLOPs, latency in ms, metrics) of a model."""
+    flops = count_flops(model, example)
+    head = sum(v for k, v in flops.items() if k.startswith(('aspp', 'decoder')))
+    wrapped = prepare_for_export(model)
+    with torch.no_grad():
+        latency = time_call(lambda: wrapped(example), iters=iters) * 1000
+    metrics = evaluate(wrapped, loader, num_class)
+    return name, head / 1e9, sum(flops.values()) / 1e9, latency, metrics
+
+
+def print_report(rows):
+    print('{:<10} {:>14} {:>14} {:>12} {:>8} {:>8}'.format('model', 'head GFLOPs', 'total GFLOPs',
+                                                          'latency (ms)', 'mIoU', 'PDR'))
+    for name, head, total, latency, metrics in rows:
+        print('{:<10} {:>14.1f} {:>14.1f} {:>12.1f} {:>8.4f} {:>8}'.format(
+            name, head, total, latency, metrics['mIoU'],
+            '-' if metrics['PDR'] is None else '%.4f' % metrics['PDR']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Structured channel pruning of the DeepLab ASPP and decoder")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--out', type=str, required=True, help='path of the pruned checkpoint')
+    parser.add_argument('--keep', type=float, default=0.5, help='fraction of channels kept in each layer')
+    parser.add_argument('--multiple', type=int, default=8, help='round the widths to a multiple of this')
+    parser.add_argument('--dataset', type=str, default='lnf')
+    parser.add_argument('--finetune-iters', type=int, default=200)
+    parser.add_argument('--finetune-frames', type=int, default=None,
+                        help='number of train frames used for fine-tuning (default: all)')
+    parser.add_argument('--finetune-backbone', action='store_true', default=False)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--eval-frames', type=int, default=None,
+                        help='number of test frames used for the accuracy report (default: all)')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--iters', type=int, default=5)
+    args = parser.parse_args()
+
+    model, config = build_model(args.checkpoint)
+    state_dict = prune_state_dict(load_state_dict(args.checkpoint), args.keep, args.multiple)
+    widths = infer_widths(state_dict)
+    pruned = DeepLab(num_classes=config['num_classes'], backbone=config['backbone'], sync_bn=False,
+                     depth=config['depth'], pretrained=False, widths=widths, aspp=config['aspp'])
+    pruned.load_state_dict(state_dict)
+    pruned.eval()
+    print('widths: {}'.format(widths))
+
+    test_loader = make_lnf_loader(args.dataset, config['depth'], 'test', args.eval_frames, args.batch_size)
+    example = next(iter(test_loader))['image'][:1]
+    rows = []
+    rows.append(report('original', model, example, test_loader, config['num_classes'], args.iters))
+    rows.append(report('pruned', pruned, example, test_loader, config['num_classes'], args.iters))
+    if args.finetune_iters > 0:
+        train_loader = make_lnf_loader(args.dataset, config['depth'], 'train', args.finetune_frames,
+                                       args.batch_size, shuffle=True)
+        finetune(pruned, train_loader, config['num_classes'], args.finetune_iters, args.lr,
+                 args.finetune_backbone)
+        rows.append(report('pruned+ft', pruned, example, test_loader, config['num_classes'], args.iters))
+
+    # train.py can resume (--ft) from the pruned checkpoint
+    torch.save({'state_dict': pruned.state_dict(), 'epoch': 0, 'best_pred': 0.0}, args.out)
+    print('saved pruned checkpoint to {}'.format(args.out))
+
+    print_report(rows)
+
+
+if __name__ == "__main__":
+    main()
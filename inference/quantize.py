@@ -0,0 +1,83 @@
+import argparse
+import torch
+from tqdm import tqdm
+from torch.ao.quantization import QConfigMapping, get_default_qconfig
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from inference.predictor import build_model
+from inference.export import prepare_for_export
+from inference.evaluate import evaluate, make_lnf_loader
+from utils.profiling import time_call
+
+# the final upsampling and confidence gating stay in fp32
+QUANTIZED_MODULES = ['model.backbone', 'model.aspp', 'model.decoder']
+
+
+def quantize(model, calibration_loader, backend='x86', max_batches=None):
+    """Static int8 post-training quantization of a DeepLab model.
+
+    Conv+BN(+ReLU) in the backbone (DRN._make_conv_layers, Bottleneck and
+    downsample branches), the ASPP branches and the decoder are fused and
+    quantized with per-channel weights; activation ranges are calibrated
+    on the batches of calibration_loader. Returns a module mapping an fp32
+    input to the fp32 (x, conf) outputs.
+    """
+    torch.backends.quantized.engine = backend
+    model = prepare_for_export(model).cpu()
+    qconfig = get_default_qconfig(backend)
+    qconfig_mapping = QConfigMapping().set_global(None)
+    for name in QUANTIZED_MODULES:
+        qconfig_mapping.set_module_name(name, qconfig)
+
+    example = next(iter(calibration_loader))['image']
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(example,))
+    with torch.no_grad():
+        for i, sample in enumerate(tqdm(calibration_loader, desc='calibration')):
+            if max_batches is not None and i >= max_batches:
+                break
+            prepared(sample['image'])
+    return convert_fx(prepared)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="int8 post-training quantization of DeepLab for CPU")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--dataset', type=str, default='lnf')
+    parser.add_argument('--calib-frames', type=int, default=300,
+                        help='number of train frames used for calibration')
+    parser.add_argument('--eval-frames', type=int, default=None,
+                        help='number of test frames used for the accuracy report (default: all)')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--out', type=str, default=None,
+                        help='path to save the quantized TorchScript module')
+    args = parser.parse_args()
+
+    model, config = build_model(args.checkpoint)
+    calibration_loader = make_lnf_loader(args.dataset, config['depth'], 'train',
+                                         args.calib_frames, args.batch_size)
+    test_loader = make_lnf_loader(args.dataset, config['depth'], 'test',
+                                  args.eval_frames, args.batch_size)
+
+    fp32 = prepare_for_export(model)
+    int8 = quantize(model, calibration_loader, args.backend)
+
+    example = next(iter(test_loader))['image']
+    print('{:<6} {:>8} {:>8} {:>10} {:>8} {:>16}'.format('model', 'mIoU', 'PDR', 'precision', 'IDR',
+                                                       'latency (ms/frame)'))
+    for name, m in [('fp32', fp32), ('int8', int8)]:
+        metrics = evaluate(m, test_loader, config['num_classes'])
+        with torch.no_grad():
+            latency = time_call(lambda: m(example), iters=args.iters) * 1000 / example.size(0)
+        print('{:<6} {:>8} {:>8} {:>10} {:>8} {:>16.1f}'.format(
+            name, *['-' if metrics[k] is None else '%.4f' % metrics[k]
+                    for k in ['mIoU', 'PDR', 'precision', 'IDR']], latency))
+
+    if args.out is not None:
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(int8, example), args.out)
+        print('saved quantized model to {}'.format(args.out))
+
+
+if __name__ == "__main__":
+    main()
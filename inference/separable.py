@@ -0,0 +1,54 @@
+import argparse
+import torch
+from modeling.deeplab import DeepLab
+from modeling.aspp import separable_state_dict
+from inference.predictor import build_model, load_state_dict
+from inference.evaluate import make_lnf_loader
+from inference.prune import finetune, report, print_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the dense ASPP of a checkpoint to the separable ASPP")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--out', type=str, required=True, help='path of the converted checkpoint')
+    parser.add_argument('--dataset', type=str, default='lnf')
+    parser.add_argument('--finetune-iters', type=int, default=200)
+    parser.add_argument('--finetune-frames', type=int, default=None,
+                        help='number of train frames used for fine-tuning (default: all)')
+    parser.add_argument('--finetune-backbone', action='store_true', default=False)
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--eval-frames', type=int, default=None,
+                        help='number of test frames used for the accuracy report (default: all)')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--iters', type=int, default=5)
+    args = parser.parse_args()
+
+    model, config = build_model(args.checkpoint)
+    if config['aspp'] != 'dense':
+        raise ValueError('{} already has a separable ASPP'.format(args.checkpoint))
+    separable = DeepLab(num_classes=config['num_classes'], backbone=config['backbone'], sync_bn=False,
+                        depth=config['depth'], pretrained=False, widths=config['widths'], aspp='separable')
+    separable.load_state_dict(separable_state_dict(load_state_dict(args.checkpoint)))
+    separable.eval()
+
+    test_loader = make_lnf_loader(args.dataset, config['depth'], 'test', args.eval_frames, args.batch_size)
+    example = next(iter(test_loader))['image'][:1]
+    rows = []
+    rows.append(report('dense', model, example, test_loader, config['num_classes'], args.iters))
+    rows.append(report('separable', separable, example, test_loader, config['num_classes'], args.iters))
+    if args.finetune_iters > 0:
+        train_loader = make_lnf_loader(args.dataset, config['depth'], 'train', args.finetune_frames,
+                                       args.batch_size, shuffle=True)
+        finetune(separable, train_loader, config['num_classes'], args.finetune_iters, args.lr,
+                 args.finetune_backbone)
+        rows.append(report('sep+ft', separable, example, test_loader, config['num_classes'], args.iters))
+
+    # train.py can resume (--ft --aspp separable) from the converted checkpoint
+    torch.save({'state_dict': separable.state_dict(), 'epoch': 0, 'best_pred': 0.0}, args.out)
+    print('saved separable checkpoint to {}'.format(args.out))
+
+    print_report(rows)
+
+
+if __name__ == "__main__":
+    main()
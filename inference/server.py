@@ -0,0 +1,224 @@
+import argparse
+import collections
+import glob
+import io
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from inference.predictor import Predictor
+
+
+class DynamicBatcher(object):
+    """Runs the frames of concurrent requests through one Predictor in batches.
+
+    A worker thread takes the oldest queued frame and adds queued frames of
+    the same shape until max_batch_size frames are collected or max_wait_ms
+    have passed since the oldest one arrived, then runs one forward. submit()
+    returns a Future of the (classes, conf) numpy maps of one frame.
+
+    Args:
+        predictor: Predictor the batches are run on
+        max_batch_size: largest batch of one forward
+        max_wait_ms: longest time a frame waits for others to join its batch
+        history: number of recent requests the latency percentiles cover
+    """
+    def __init__(self, predictor, max_batch_size=8, max_wait_ms=10, history=1000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._carry = None
+        self._lock = threading.Lock()
+        self._latency = collections.deque(maxlen=history)
+        self._batch_time = collections.deque(maxlen=history)
+        self.requests = 0
+        self.batches = 0
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, frame):
+        frame = np.asarray(frame)
+        # rejected here, a bad frame would fail the whole batch it joins
+        if frame.dtype != np.uint8 or frame.ndim != 3 or frame.shape[-1] != self.predictor.channels:
+            raise ValueError('Expected a uint8 frame of shape (H, W, {}), got {} {}'.format(
+                self.predictor.channels, frame.dtype, frame.shape))
+        future = Future()
+        self._queue.put((frame, future, time.perf_counter()))
+        return future
+
+    def _next(self, timeout=None):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._next()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._next(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item[0].shape != batch[0][0].shape:
+                # starts the next batch
+                self._carry = item
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                classes, conf = self.predictor(np.stack([frame for frame, _, _ in batch]))
+                # classes and conf are the Predictor's reused output buffers, copied
+                # (astype copies) before the next batch overwrites them
+                results = [(c.cpu().numpy().astype(np.uint8), f.cpu().numpy().copy()) for c, f in zip(classes, conf)]
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            with self._lock:
+                self.requests += len(batch)
+                self.batches += 1
+                self._batch_time.append(end - start)
+                self._latency.extend(end - submitted for _, _, submitted in batch)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        """Queue depth, batch counts and latency percentiles in ms."""
+        with self._lock:
+            latency = np.array(self._latency) * 1000
+            batch_time = np.array(self._batch_time) * 1000
+            requests, batches = self.requests, self.batches
+
+        def percentiles(values):
+            if len(values) == 0:
+                return None
+            return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+                    'p99': float(np.percentile(values, 99))}
+
+        return {'queue_depth': self._queue.qsize() + (self._carry is not None),
+                'requests': requests,
+                'batches': batches,
+                'mean_batch_size': requests / batches if batches else None,
+                'latency_ms': percentiles(latency),
+                'batch_ms': percentiles(batch_time)}
+
+
+def encode(**arrays):
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def decode(data):
+    return dict(np.load(io.BytesIO(data)))
+
+
+class Handler(BaseHTTPRequestHandler):
+    """POST /predict with an npz body holding one uint8 'frame' (H, W, 3 or 4)
+    returns an npz with the 'classes' (uint8) and 'conf' (float32) maps.
+    GET /stats returns DynamicBatcher.stats() as JSON."""
+
+    def _reply(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, b'not found\n', 'text/plain')
+        self._reply(200, json.dumps(self.server.batcher.stats()).encode(), 'application/json')
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._reply(404, b'not found\n', 'text/plain')
+        try:
+            frame = decode(self.rfile.read(int(self.headers['Content-Length'])))['frame']
+            classes, conf = self.server.batcher.submit(frame).result()
+        except Exception as e:
+            return self._reply(400, '{}\n'.format(e).encode(), 'text/plain')
+        self._reply(200, encode(classes=classes, conf=conf), 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(batcher, host='127.0.0.1', port=8080):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    return server
+
+
+def request(url, frame):
+    with urllib.request.urlopen(url + '/predict', data=encode(frame=frame)) as response:
+        result = decode(response.read())
+    return result['classes'], result['conf']
+
+
+def run_client(url, frames, num_requests, concurrency):
+    """Sends num_requests frames from concurrency threads, returns client side
+    latencies in ms and the overall frames/s."""
+    def send(i):
+        start = time.perf_counter()
+        request(url, frames[i % len(frames)])
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latency = list(pool.map(send, range(num_requests)))
+    return np.array(latency), num_requests / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    # serve a checkpoint, or (--client) load test a running server
+    parser = argparse.ArgumentParser(description="Dynamic batching inference server")
+    parser.add_argument('--checkpoint', type=str, default=None)
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10)
+    parser.add_argument('--client', type=str, default=None,
+                        help='url of a running server to send frames to, e.g. http://127.0.0.1:8080')
+    parser.add_argument('--frames', type=str, default=None,
+                        help='directory of png frames for the client (default: random frames)')
+    parser.add_argument('--size', type=int, nargs=3, default=[512, 1792, 3],
+                        help='shape of the random client frames')
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.client is not None:
+        if args.frames is not None:
+            from PIL import Image
+            frames = [np.asarray(Image.open(path).convert('RGB'))
+                      for path in sorted(glob.glob(os.path.join(args.frames, '*.png')))]
+        else:
+            frames = [np.random.randint(0, 256, args.size, dtype=np.uint8) for _ in range(4)]
+        latency, fps = run_client(args.client, frames, args.requests, args.concurrency)
+        print('client: {:.2f} frames/s, latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms'.format(
+            fps, *np.percentile(latency, [50, 90, 99])))
+        with urllib.request.urlopen(args.client + '/stats') as response:
+            print('server: {}'.format(response.read().decode()))
+    else:
+        if args.checkpoint is None:
+            parser.error('--checkpoint is required to serve')
+        predictor = Predictor(args.checkpoint, device='cuda' if torch.cuda.is_available() else 'cpu')
+        server = serve(DynamicBatcher(predictor, args.max_batch_size, args.max_wait_ms), args.host, args.port)
+        print('serving {} on http://{}:{}'.format(args.checkpoint, args.host, args.port))
+        server.serve_forever()
@@ -0,0 +1,115 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import torch
+from inference.predictor import Predictor
+from utils.profiling import synchronize
+
+
+class StreamingPredictor(Predictor):
+    """Key-frame inference on the consecutive frames of a driving sequence.
+
+    The deep features (backbone.forward_high and ASPP) are computed on key
+    frames only. In between, only the low level features (DRN up to layer3)
+    and the decoder are run, and the decoder combines them with the cached
+    deep features of the last key frame. A frame becomes a key frame when the
+    mean absolute change of its low level features relative to the last key
+    frame exceeds threshold, or after max_interval frames.
+
+    Args:
+        threshold: relative low level feature change that triggers a key frame
+        max_interval: maximum number of frames between two key frames
+        other arguments as for Predictor
+
+    Frames passed to predict() are taken as consecutive frames of one
+    sequence, across calls; call reset() at the start of a new sequence.
+    """
+    def __init__(self, checkpoint, threshold=0.2, max_interval=10, **kwargs):
+        super(StreamingPredictor, self).__init__(checkpoint, **kwargs)
+        if not hasattr(self.model.backbone, 'forward_low'):
+            raise NotImplementedError('{} backbone has no low/high level split'.format(self.config['backbone']))
+        self.threshold = threshold
+        self.max_interval = max_interval
+        self.reset()
+
+    def reset(self):
+        self._key_low = None
+        self._key_features = None
+        self._since_key = 0
+        self.frames = 0
+        self.key_frames = 0
+
+    def change(self, low):
+        """Mean absolute change of low level features relative to the key frame."""
+        return ((low - self._key_low).abs().mean() / self._key_low.abs().mean().clamp(min=1e-6)).item()
+
+    def _is_key(self, low):
+        return (self._key_low is None or self._key_low.shape != low.shape
+                or self._since_key >= self.max_interval or self.change(low) > self.threshold)
+
+    def forward(self, image):
+        outputs = []
+        for frame in image.split(1):
+            low = self.model.backbone.forward_low(frame)
+            if self._is_key(low):
+                self._key_features = self.model.aspp(self.model.backbone.forward_high(low))
+                self._key_low = low
+                self._since_key = 0
+                self.key_frames += 1
+            self._since_key += 1
+            self.frames += 1
+            x, conf = self.model.decoder(self._key_features, low)
+            outputs.append(self.model.gate_and_upsample(x, conf, frame.size()[2:], 'fused'))
+        return tuple(torch.cat(out) for out in zip(*outputs))
+
+
+def load_frames(paths, disparity_paths=None):
+    from PIL import Image
+    for i, path in enumerate(paths):
+        frame = np.asarray(Image.open(path).convert('RGB'))
+        if disparity_paths is not None:
+            disparity = np.rint(np.asarray(Image.open(disparity_paths[i])) / 256).astype(np.uint8)
+            frame = np.concatenate((frame, disparity[:, :, None]), axis=2)
+        yield frame
+
+
+if __name__ == "__main__":
+    # per frame inference vs key-frame streaming on one sequence
+    parser = argparse.ArgumentParser(description="Key-frame streaming inference on an LNF sequence")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--sequence', type=str, required=True,
+                        help='directory with the frames of one sequence, e.g. leftImg8bit/test/seq_a')
+    parser.add_argument('--disparity', type=str, default=None,
+                        help='directory with the disparity frames for RGB-D checkpoints')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--max-interval', type=int, default=10)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.sequence, '*.png')))
+    disparity_paths = None
+    if args.disparity is not None:
+        disparity_paths = sorted(glob.glob(os.path.join(args.disparity, '*.png')))
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    predictor = Predictor(args.checkpoint, device=device)
+    streaming = StreamingPredictor(args.checkpoint, threshold=args.threshold,
+                                   max_interval=args.max_interval, device=device)
+
+    full_time = stream_time = 0.0
+    agreement = []
+    for frame in load_frames(paths, disparity_paths):
+        start = time.perf_counter()
+        classes = predictor(frame)[0].clone()
+        synchronize(device)
+        full_time += time.perf_counter() - start
+        start = time.perf_counter()
+        streamed = streaming(frame)[0]
+        synchronize(device)
+        stream_time += time.perf_counter() - start
+        agreement.append((classes == streamed).float().mean().item())
+
+    print('frames: {}, key frames: {}'.format(streaming.frames, streaming.key_frames))
+    print('per frame: {:.1f} ms, streaming: {:.1f} ms'.format(
+        1000 * full_time / len(paths), 1000 * stream_time / len(paths)))
+    print('class map agreement: mean {:.4f}, min {:.4f}'.format(np.mean(agreement), np.min(agreement)))
@@ -0,0 +1,106 @@
+import argparse
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from inference.predictor import build_model
+from inference.evaluate import evaluate, make_lnf_loader
+
+
+class TestTimeAugmentation(nn.Module):
+    """Flip and multi-scale test-time augmentation of a DeepLab model.
+
+    The (scale, flip) views of the input batch are stacked into batched
+    forwards: with batch='scale' one forward per scale (the flipped and
+    unflipped views together), with batch='all' a single forward in which
+    every view is placed top-left on a zero canvas of the largest view size
+    (zero is the dataset mean after normalization; the padding costs FLOPs
+    and slightly changes the smaller views), with batch='none' one forward
+    per view. The outputs are cropped to their view, resized to the input
+    size, flipped back and averaged, for the gated logits and the confidence.
+
+    forward() returns (x, conf) at input resolution, as DeepLab(resolution='fused').
+    """
+    def __init__(self, model, scales=(1.0,), flip=True, batch='scale'):
+        super(TestTimeAugmentation, self).__init__()
+        if batch not in ('scale', 'all', 'none'):
+            raise NotImplementedError(batch)
+        self.model = model
+        self.scales = scales
+        self.flip = flip
+        self.batch = batch
+
+    def views(self):
+        return [(scale, flip) for scale in self.scales for flip in ((False, True) if self.flip else (False,))]
+
+    def groups(self, views):
+        """Indices of the views run in one forward."""
+        if self.batch == 'all':
+            return [list(range(len(views)))]
+        if self.batch == 'none':
+            return [[k] for k in range(len(views))]
+        return [[k for k, view in enumerate(views) if view[0] == scale] for scale in self.scales]
+
+    def forward(self, image):
+        n, c, h, w = image.shape
+        views = self.views()
+        sizes = [(int(round(h * scale)), int(round(w * scale))) for scale, _ in views]
+        outputs = [None] * len(views)
+        for group in self.groups(views):
+            height, width = max(sizes[k][0] for k in group), max(sizes[k][1] for k in group)
+            batch = image.new_zeros(len(group) * n, c, height, width)
+            if image.is_contiguous(memory_format=torch.channels_last):
+                batch = batch.contiguous(memory_format=torch.channels_last)
+            for i, k in enumerate(group):
+                scale, flip = views[k]
+                view = image if sizes[k] == (h, w) else F.interpolate(image, size=sizes[k], mode='bilinear',
+                                                                      align_corners=True)
+                batch[i * n:(i + 1) * n, :, :sizes[k][0], :sizes[k][1]] = view.flip(3) if flip else view
+            x, conf = self.model(batch, resolution='fused')
+            for i, k in enumerate(group):
+                outputs[k] = (x[i * n:(i + 1) * n, :, :sizes[k][0], :sizes[k][1]],
+                              conf[i * n:(i + 1) * n, :, :sizes[k][0], :sizes[k][1]])
+
+        x_sum = conf_sum = 0
+        for (scale, flip), (x, conf) in zip(views, outputs):
+            if flip:
+                x, conf = x.flip(3), conf.flip(3)
+            if x.size()[2:] != (h, w):
+                x = F.interpolate(x, size=(h, w), mode='bilinear', align_corners=True)
+                conf = F.interpolate(conf, size=(h, w), mode='bilinear', align_corners=True)
+            x_sum = x_sum + x
+            conf_sum = conf_sum + conf
+        return x_sum / len(views), conf_sum / len(views)
+
+
+if __name__ == "__main__":
+    # throughput and accuracy of TTA configurations on the test split
+    parser = argparse.ArgumentParser(description="Flip and multi-scale test-time augmentation report")
+    parser.add_argument('--checkpoint', type=str, required=True)
+    parser.add_argument('--dataset', type=str, default='lnf')
+    parser.add_argument('--eval-frames', type=int, default=None,
+                        help='number of test frames used for the report (default: all)')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.75, 1.0, 1.25])
+    parser.add_argument('--no-flip', action='store_true', default=False)
+    args = parser.parse_args()
+
+    model, config = build_model(args.checkpoint, device='cuda' if torch.cuda.is_available() else 'cpu')
+    device = next(model.parameters()).device
+    loader = make_lnf_loader(args.dataset, config['depth'], 'test', args.eval_frames, args.batch_size)
+    flip = not args.no_flip
+    configs = [('none', TestTimeAugmentation(model, (1.0,), False)),
+               ('flip', TestTimeAugmentation(model, (1.0,), flip)),
+               ('scales per view', TestTimeAugmentation(model, args.scales, flip, batch='none')),
+               ('scales per scale', TestTimeAugmentation(model, args.scales, flip, batch='scale')),
+               ('scales all', TestTimeAugmentation(model, args.scales, flip, batch='all'))]
+
+    print('{:<22} {:>6} {:>9} {:>8} {:>8}'.format('tta', 'views', 'frames/s', 'mIoU', 'PDR'))
+    for name, tta in configs:
+        start = time.perf_counter()
+        metrics = evaluate(lambda image: [out.cpu() for out in tta(image.to(device))],
+                           loader, config['num_classes'])
+        fps = len(loader.dataset) / (time.perf_counter() - start)
+        print('{:<22} {:>6} {:>9.2f} {:>8.4f} {:>8}'.format(
+            name, len(tta.views()), fps, metrics['mIoU'],
+            '-' if metrics['PDR'] is None else '%.4f' % metrics['PDR']))
@@ -4,11 +4,19 @@ import torch.nn as nn
 import torch.nn.functional as F
 from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
 
+ASPP_TYPES = ['dense', 'separable']
+
 class _ASPPModule(nn.Module):
-    def __init__(self, inplanes, planes, kernel_size, padding, dilation, BatchNorm):
+    def __init__(self, inplanes, planes, kernel_size, padding, dilation, BatchNorm, separable=False):
         super(_ASPPModule, self).__init__()
-        self.atrous_conv = nn.Conv2d(inplanes, planes, kernel_size=kernel_size,
-                                            stride=1, padding=padding, dilation=dilation, bias=False)
+        if separable and kernel_size > 1:
+            # depthwise atrous conv + BN + pointwise conv, as in the xception backbone
+            from modeling.backbone.xception import SeparableConv2d
+            self.atrous_conv = SeparableConv2d(inplanes, planes, kernel_size, dilation=dilation,
+                                               BatchNorm=BatchNorm)
+        else:
+            self.atrous_conv = nn.Conv2d(inplanes, planes, kernel_size=kernel_size,
+                                                stride=1, padding=padding, dilation=dilation, bias=False)
         self.bn = BatchNorm(planes)
         self.relu = nn.ReLU()
 
@@ -32,7 +40,7 @@ class _ASPPModule(nn.Module):
                 m.bias.data.zero_()
 
 class ASPP(nn.Module):
-    def __init__(self, backbone, output_stride, BatchNorm):
+    def __init__(self, backbone, output_stride, BatchNorm, widths=None, separable=False):
         super(ASPP, self).__init__()
         if backbone == 'drn':
             inplanes = 512
@@ -47,19 +55,30 @@ class ASPP(nn.Module):
         else:
             raise NotImplementedError
 
-        self.aspp1 = _ASPPModule(inplanes, 256, 1, padding=0, dilation=dilations[0], BatchNorm=BatchNorm)
-        self.aspp2 = _ASPPModule(inplanes, 256, 3, padding=dilations[1], dilation=dilations[1], BatchNorm=BatchNorm)
-        self.aspp3 = _ASPPModule(inplanes, 256, 3, padding=dilations[2], dilation=dilations[2], BatchNorm=BatchNorm)
-        self.aspp4 = _ASPPModule(inplanes, 256, 3, padding=dilations[3], dilation=dilations[3], BatchNorm=BatchNorm)
+        # channel widths of the four branches and the image pooling branch, and of
+        # the projection; smaller in pruned models (inference/prune.py)
+        widths = widths or {}
+        branches = widths.get('aspp', [256] * 5)
+        planes = widths.get('aspp_out', 256)
+
+        self.aspp1 = _ASPPModule(inplanes, branches[0], 1, padding=0, dilation=dilations[0], BatchNorm=BatchNorm)
+        self.aspp2 = _ASPPModule(inplanes, branches[1], 3, padding=dilations[1], dilation=dilations[1], BatchNorm=BatchNorm,
+                                 separable=separable)
+        self.aspp3 = _ASPPModule(inplanes, branches[2], 3, padding=dilations[2], dilation=dilations[2], BatchNorm=BatchNorm,
+                                 separable=separable)
+        self.aspp4 = _ASPPModule(inplanes, branches[3], 3, padding=dilations[3], dilation=dilations[3], BatchNorm=BatchNorm,
+                                 separable=separable)
 
         self.global_avg_pool = nn.Sequential(nn.AdaptiveAvgPool2d((1, 1)),
-                                             nn.Conv2d(inplanes, 256, 1, stride=1, bias=False),
-                                             BatchNorm(256),
+                                             nn.Conv2d(inplanes, branches[4], 1, stride=1, bias=False),
+                                             BatchNorm(branches[4]),
                                              nn.ReLU())
-        self.conv1 = nn.Conv2d(1280, 256, 1, bias=False)
-        self.bn1 = BatchNorm(256)
+        self.conv1 = nn.Conv2d(sum(branches), planes, 1, bias=False)
+        self.bn1 = BatchNorm(planes)
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(0.5)
+        # memory format of the concatenated branches, set by DeepLab.set_memory_format
+        self.memory_format = torch.contiguous_format
         self._init_weight()
 
     def forward(self, x):
@@ -69,7 +88,9 @@ class ASPP(nn.Module):
         x4 = self.aspp4(x)
         x5 = self.global_avg_pool(x)
         x5 = F.interpolate(x5, size=x4.size()[2:], mode='bilinear', align_corners=True)
-        x = torch.cat((x1, x2, x3, x4, x5), dim=1)
+        # the upsampled 1x1 pooling branch is NCHW, which would make the whole
+        # concatenation NCHW in a channels_last model
+        x = torch.cat((x1, x2, x3, x4, x5), dim=1).contiguous(memory_format=self.memory_format)
 
         x = self.conv1(x)
         x = self.bn1(x)
@@ -91,5 +112,37 @@ class ASPP(nn.Module):
                 m.bias.data.zero_()
 
 
-def build_aspp(backbone, output_stride, BatchNorm):
-    return ASPP(backbone, output_stride, BatchNorm)
\ No newline at end of file
+def build_aspp(backbone, output_stride, BatchNorm, widths=None, aspp='dense'):
+    if aspp not in ASPP_TYPES:
+        raise NotImplementedError(aspp)
+    return ASPP(backbone, output_stride, BatchNorm, widths, separable=aspp == 'separable')
+
+
+def separable_state_dict(state_dict):
+    """Converts a DeepLab state dict with dense ASPP branches to the separable ASPP.
+
+    Every dense 3x3 atrous kernel W is replaced by the best rank-1 approximation
+    of W[:, i] per input channel i (SVD of the out x 9 matrix), split into the
+    depthwise filter of channel i and column i of the pointwise conv. The BN
+    between them starts as identity. All other entries are copied.
+    """
+    state_dict = dict(state_dict)
+    for i in (2, 3, 4):
+        prefix = 'aspp.aspp{}.atrous_conv.'.format(i)
+        if prefix + 'weight' not in state_dict:
+            continue
+        weight = state_dict.pop(prefix + 'weight')
+        planes, inplanes, kh, kw = weight.shape
+        u, s, v = torch.linalg.svd(weight.permute(1, 0, 2, 3).reshape(inplanes, planes, kh * kw).float(),
+                                   full_matrices=False)
+        scale = s[:, 0].sqrt()
+        state_dict[prefix + 'pointwise.weight'] = (u[:, :, 0] * scale[:, None]).t().reshape(
+            planes, inplanes, 1, 1).to(weight.dtype)
+        state_dict[prefix + 'conv1.weight'] = (v[:, 0, :] * scale[:, None]).reshape(
+            inplanes, 1, kh, kw).to(weight.dtype)
+        state_dict[prefix + 'bn.weight'] = torch.full((inplanes,), math.sqrt(1 + 1e-5))
+        state_dict[prefix + 'bn.bias'] = torch.zeros(inplanes)
+        state_dict[prefix + 'bn.running_mean'] = torch.zeros(inplanes)
+        state_dict[prefix + 'bn.running_var'] = torch.ones(inplanes)
+        state_dict[prefix + 'bn.num_batches_tracked'] = torch.tensor(0)
+    return state_dict
\ No newline at end of file
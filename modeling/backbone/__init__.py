@@ -1,14 +1,17 @@
-from modeling.backbone import resnet, xception, drn, mobilenet
-
-def build_backbone(backbone, output_stride, BatchNorm, depth=False):
+def build_backbone(backbone, output_stride, BatchNorm, depth=False, pretrained=True):
+    # backbone modules are imported only when selected
     if backbone == 'resnet':
-        return resnet.ResNet101(output_stride, BatchNorm)
+        from modeling.backbone import resnet
+        return resnet.ResNet101(output_stride, BatchNorm, pretrained=pretrained, depth=depth)
     elif backbone == 'xception':
-        return xception.AlignedXception(output_stride, BatchNorm)
+        from modeling.backbone import xception
+        return xception.AlignedXception(output_stride, BatchNorm, pretrained=pretrained, depth=depth)
     elif backbone == 'drn':
+        from modeling.backbone import drn
         print('backbone constructor:',depth)
-        return drn.drn_d_54(BatchNorm, Depth=depth)
+        return drn.drn_d_54(BatchNorm, pretrained=pretrained, Depth=depth)
     elif backbone == 'mobilenet':
-        return mobilenet.MobileNetV2(output_stride, BatchNorm)
+        from modeling.backbone import mobilenet
+        return mobilenet.MobileNetV2(output_stride, BatchNorm, pretrained=pretrained, depth=depth)
     else:
         raise NotImplementedError
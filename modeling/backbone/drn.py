@@ -1,7 +1,9 @@
 import torch.nn as nn
 import math
-import torch.utils.model_zoo as model_zoo
 from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
+from modeling import checkpointing
+from modeling.backbone.inflate import inflate_input_channels
+from modeling.backbone.weights import load_url
 
 webroot = 'http://dl.yf.io/drn/'
 
@@ -110,6 +112,8 @@ class DRN(nn.Module):
         self.arch = arch
         print('DRN constr', depth)
         self.depth = depth
+        # activation checkpointing of layer1-layer8, see modeling/checkpointing.py
+        self.checkpointing = 'none'
 
         if arch == 'C':
             self.conv1 = nn.Conv2d(3, channels[0], kernel_size=7, stride=1,
@@ -214,6 +218,11 @@ class DRN(nn.Module):
         return nn.Sequential(*modules)
 
     def forward(self, x):
+        low_level_feat = self.forward_low(x)
+        return self.forward_high(low_level_feat), low_level_feat
+
+    def forward_low(self, x):
+        # stem to layer3, the low level features of the decoder
         if self.arch == 'C':
             x = self.conv1(x)
             x = self.bn1(x)
@@ -221,25 +230,27 @@ class DRN(nn.Module):
         elif self.arch == 'D':
             x = self.layer0(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
+        x = checkpointing.run(self.layer1, x, self.checkpointing)
+        x = checkpointing.run(self.layer2, x, self.checkpointing)
 
-        x = self.layer3(x)
-        low_level_feat = x
+        x = checkpointing.run(self.layer3, x, self.checkpointing)
+        return x
 
-        x = self.layer4(x)
-        x = self.layer5(x)
+    def forward_high(self, x):
+        # layer4 to layer8 on the low level features
+        x = checkpointing.run(self.layer4, x, self.checkpointing)
+        x = checkpointing.run(self.layer5, x, self.checkpointing)
 
         if self.layer6 is not None:
-            x = self.layer6(x)
+            x = checkpointing.run(self.layer6, x, self.checkpointing)
 
         if self.layer7 is not None:
-            x = self.layer7(x)
+            x = checkpointing.run(self.layer7, x, self.checkpointing)
 
         if self.layer8 is not None:
-            x = self.layer8(x)
+            x = checkpointing.run(self.layer8, x, self.checkpointing)
 
-        return x, low_level_feat
+        return x
 
 
 class DRN_A(nn.Module):
@@ -308,14 +319,14 @@ class DRN_A(nn.Module):
 def drn_a_50(BatchNorm, pretrained=True):
     model = DRN_A(Bottleneck, [3, 4, 6, 3], BatchNorm=BatchNorm)
     if pretrained:
-        model.load_state_dict(model_zoo.load_url(model_urls['resnet50']))
+        model.load_state_dict(load_url(model_urls['resnet50']))
     return model
 
 
 def drn_c_26(BatchNorm, pretrained=True):
     model = DRN(BasicBlock, [1, 1, 2, 2, 2, 2, 1, 1], arch='C', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-c-26'])
+        pretrained = load_url(model_urls['drn-c-26'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -325,7 +336,7 @@ def drn_c_26(BatchNorm, pretrained=True):
 def drn_c_42(BatchNorm, pretrained=True):
     model = DRN(BasicBlock, [1, 1, 3, 4, 6, 3, 1, 1], arch='C', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-c-42'])
+        pretrained = load_url(model_urls['drn-c-42'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -335,7 +346,7 @@ def drn_c_42(BatchNorm, pretrained=True):
 def drn_c_58(BatchNorm, pretrained=True):
     model = DRN(Bottleneck, [1, 1, 3, 4, 6, 3, 1, 1], arch='C', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-c-58'])
+        pretrained = load_url(model_urls['drn-c-58'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -345,7 +356,7 @@ def drn_c_58(BatchNorm, pretrained=True):
 def drn_d_22(BatchNorm, pretrained=True):
     model = DRN(BasicBlock, [1, 1, 2, 2, 2, 2, 1, 1], arch='D', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-d-22'])
+        pretrained = load_url(model_urls['drn-d-22'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -355,7 +366,7 @@ def drn_d_22(BatchNorm, pretrained=True):
 def drn_d_24(BatchNorm, pretrained=True):
     model = DRN(BasicBlock, [1, 1, 2, 2, 2, 2, 2, 2], arch='D', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-d-24'])
+        pretrained = load_url(model_urls['drn-d-24'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -365,7 +376,7 @@ def drn_d_24(BatchNorm, pretrained=True):
 def drn_d_38(BatchNorm, pretrained=True):
     model = DRN(BasicBlock, [1, 1, 3, 4, 6, 3, 1, 1], arch='D', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-d-38'])
+        pretrained = load_url(model_urls['drn-d-38'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -375,7 +386,7 @@ def drn_d_38(BatchNorm, pretrained=True):
 def drn_d_40(BatchNorm, pretrained=True):
     model = DRN(BasicBlock, [1, 1, 3, 4, 6, 3, 2, 2], arch='D', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-d-40'])
+        pretrained = load_url(model_urls['drn-d-40'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -386,21 +397,18 @@ def drn_d_54(BatchNorm, pretrained=True, Depth=False):
     model = DRN(Bottleneck, [1, 1, 3, 4, 6, 3, 1, 1], arch='D',
                 BatchNorm=BatchNorm, depth=Depth)
     if pretrained:
-        if not Depth:
-            pretrained = model_zoo.load_url(model_urls['drn-d-54'])
-            del pretrained['fc.weight']
-            del pretrained['fc.bias']
-            model.load_state_dict(pretrained)
-            return model
-        else:
-            return model
+        pretrained = load_url(model_urls['drn-d-54'])
+        del pretrained['fc.weight']
+        del pretrained['fc.bias']
+        inflate_input_channels(pretrained, 'layer0.0.weight', 4 if Depth else 3)
+        model.load_state_dict(pretrained)
     return model
 
 
 def drn_d_105(BatchNorm, pretrained=True):
     model = DRN(Bottleneck, [1, 1, 3, 4, 23, 3, 1, 1], arch='D', BatchNorm=BatchNorm)
     if pretrained:
-        pretrained = model_zoo.load_url(model_urls['drn-d-105'])
+        pretrained = load_url(model_urls['drn-d-105'])
         del pretrained['fc.weight']
         del pretrained['fc.bias']
         model.load_state_dict(pretrained)
@@ -0,0 +1,17 @@
+import torch
+
+
+def inflate_input_channels(state_dict, key, in_channels):
+    """Inflates the RGB stem conv weight state_dict[key] of an ImageNet model
+    to in_channels inputs, in place.
+
+    The RGB filters are copied and every extra (depth) filter is initialised
+    with the mean of the RGB filters, so that a depth map with the scale of
+    an image channel gives a response of the same scale.
+    """
+    weight = state_dict[key]
+    if weight.shape[1] == in_channels:
+        return state_dict
+    extra = weight.mean(dim=1, keepdim=True).repeat(1, in_channels - weight.shape[1], 1, 1)
+    state_dict[key] = torch.cat([weight, extra], dim=1)
+    return state_dict
@@ -3,7 +3,8 @@ import torch.nn.functional as F
 import torch.nn as nn
 import math
 from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
-import torch.utils.model_zoo as model_zoo
+from modeling.backbone.inflate import inflate_input_channels
+from modeling.backbone.weights import PRETRAINED_URLS, load_url
 
 def conv_bn(inp, oup, stride, BatchNorm):
     return nn.Sequential(
@@ -68,7 +69,7 @@ class InvertedResidual(nn.Module):
 
 
 class MobileNetV2(nn.Module):
-    def __init__(self, output_stride=8, BatchNorm=None, width_mult=1., pretrained=True):
+    def __init__(self, output_stride=8, BatchNorm=None, width_mult=1., pretrained=True, depth=False):
         super(MobileNetV2, self).__init__()
         block = InvertedResidual
         input_channel = 32
@@ -87,7 +88,7 @@ class MobileNetV2(nn.Module):
 
         # building first layer
         input_channel = int(input_channel * width_mult)
-        self.features = [conv_bn(3, input_channel, 2, BatchNorm)]
+        self.features = [conv_bn(4 if depth else 3, input_channel, 2, BatchNorm)]
         current_stride *= 2
         # building inverted residual blocks
         for t, c, n, s in interverted_residual_setting:
@@ -116,12 +117,18 @@ class MobileNetV2(nn.Module):
         self.high_level_features = self.features[4:]
 
     def forward(self, x):
-        low_level_feat = self.low_level_features(x)
-        x = self.high_level_features(low_level_feat)
-        return x, low_level_feat
+        low_level_feat = self.forward_low(x)
+        return self.forward_high(low_level_feat), low_level_feat
+
+    def forward_low(self, x):
+        return self.low_level_features(x)
+
+    def forward_high(self, x):
+        return self.high_level_features(x)
 
     def _load_pretrained_model(self):
-        pretrain_dict = model_zoo.load_url('http://jeff95.me/models/mobilenet_v2-6a65762b.pth')
+        pretrain_dict = load_url(PRETRAINED_URLS['mobilenet'])
+        inflate_input_channels(pretrain_dict, 'features.0.0.weight', self.features[0][0].in_channels)
         model_dict = {}
         state_dict = self.state_dict()
         for k, v in pretrain_dict.items():
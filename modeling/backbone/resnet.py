@@ -1,7 +1,9 @@
 import math
 import torch.nn as nn
-import torch.utils.model_zoo as model_zoo
 from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
+from modeling import checkpointing
+from modeling.backbone.inflate import inflate_input_channels
+from modeling.backbone.weights import PRETRAINED_URLS, load_url
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -44,9 +46,11 @@ class Bottleneck(nn.Module):
 
 class ResNet(nn.Module):
 
-    def __init__(self, block, layers, output_stride, BatchNorm, pretrained=True):
+    def __init__(self, block, layers, output_stride, BatchNorm, pretrained=True, depth=False):
         self.inplanes = 64
         super(ResNet, self).__init__()
+        # activation checkpointing of layer1-layer4, see modeling/checkpointing.py
+        self.checkpointing = 'none'
         blocks = [1, 2, 4]
         if output_stride == 16:
             strides = [1, 2, 2, 1]
@@ -58,7 +62,7 @@ class ResNet(nn.Module):
             raise NotImplementedError
 
         # Modules
-        self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
+        self.conv1 = nn.Conv2d(4 if depth else 3, 64, kernel_size=7, stride=2, padding=3,
                                 bias=False)
         self.bn1 = BatchNorm(64)
         self.relu = nn.ReLU(inplace=True)
@@ -111,17 +115,22 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, input):
+        low_level_feat = self.forward_low(input)
+        return self.forward_high(low_level_feat), low_level_feat
+
+    def forward_low(self, input):
+        # stem and layer1, the low level features of the decoder
         x = self.conv1(input)
         x = self.bn1(x)
         x = self.relu(x)
         x = self.maxpool(x)
+        return checkpointing.run(self.layer1, x, self.checkpointing)
 
-        x = self.layer1(x)
-        low_level_feat = x
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
-        return x, low_level_feat
+    def forward_high(self, x):
+        x = checkpointing.run(self.layer2, x, self.checkpointing)
+        x = checkpointing.run(self.layer3, x, self.checkpointing)
+        x = checkpointing.run(self.layer4, x, self.checkpointing)
+        return x
 
     def _init_weight(self):
         for m in self.modules():
@@ -136,7 +145,8 @@ class ResNet(nn.Module):
                 m.bias.data.zero_()
 
     def _load_pretrained_model(self):
-        pretrain_dict = model_zoo.load_url('https://download.pytorch.org/models/resnet101-5d3b4d8f.pth')
+        pretrain_dict = load_url(PRETRAINED_URLS['resnet'])
+        inflate_input_channels(pretrain_dict, 'conv1.weight', self.conv1.in_channels)
         model_dict = {}
         state_dict = self.state_dict()
         for k, v in pretrain_dict.items():
@@ -145,12 +155,14 @@ class ResNet(nn.Module):
         state_dict.update(model_dict)
         self.load_state_dict(state_dict)
 
-def ResNet101(output_stride, BatchNorm, pretrained=True):
+def ResNet101(output_stride, BatchNorm, pretrained=True, depth=False):
     """Constructs a ResNet-101 model.
     Args:
         pretrained (bool): If True, returns a model pre-trained on ImageNet
+        depth (bool): If True, the stem takes RGB-D input and the pretrained
+            RGB filters are inflated to 4 channels
     """
-    model = ResNet(Bottleneck, [3, 4, 23, 3], output_stride, BatchNorm, pretrained=pretrained)
+    model = ResNet(Bottleneck, [3, 4, 23, 3], output_stride, BatchNorm, pretrained=pretrained, depth=depth)
     return model
 
 if __name__ == "__main__":
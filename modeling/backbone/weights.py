@@ -0,0 +1,158 @@
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import torch
+from urllib.parse import urlparse
+from mypath import Path
+
+# ImageNet weights used by build_backbone
+PRETRAINED_URLS = {
+    'resnet': 'https://download.pytorch.org/models/resnet101-5d3b4d8f.pth',
+    'xception': 'http://data.lip6.fr/cadene/pretrainedmodels/xception-b5690688.pth',
+    'drn': 'http://dl.yf.io/drn/drn_d_54-0e0534ff.pth',
+    'mobilenet': 'http://jeff95.me/models/mobilenet_v2-6a65762b.pth',
+}
+
+# checksums of the stored files, in `sha256sum -c` format
+MANIFEST = 'SHA256SUMS'
+
+# sha256 prefix in the file name of a weights url, as matched by torch.hub
+HASH_REGEX = re.compile(r'-([a-f0-9]*)\.')
+
+
+def local_path(url):
+    return os.path.join(Path.weights_dir(), os.path.basename(urlparse(url).path))
+
+
+def sha256sum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_manifest():
+    path = os.path.join(Path.weights_dir(), MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {name: digest for digest, name in (line.split() for line in f if line.strip())}
+
+
+@contextlib.contextmanager
+def store_lock():
+    """Exclusive flock of the weight store, held while the manifest or the
+    stored files are changed."""
+    os.makedirs(Path.weights_dir(), exist_ok=True)
+    with open(os.path.join(Path.weights_dir(), MANIFEST + '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_manifest(manifest):
+    # replaced atomically, readers see the old or the new manifest
+    path = os.path.join(Path.weights_dir(), MANIFEST)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        for name in sorted(manifest):
+            f.write('{}  {}\n'.format(manifest[name], name))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def record(path):
+    """Adds the checksum of a stored file to the manifest."""
+    with store_lock():
+        manifest = read_manifest()
+        manifest[os.path.basename(path)] = sha256sum(path)
+        write_manifest(manifest)
+
+
+def verify(path):
+    digest = read_manifest().get(os.path.basename(path))
+    if digest is None:
+        raise RuntimeError('No checksum recorded for {} in {}, run python -m modeling.backbone.weights '
+                           '--record after checking the file'.format(path, MANIFEST))
+    if sha256sum(path) != digest:
+        raise RuntimeError('Checksum mismatch for {}'.format(path))
+
+
+def fetch(url):
+    """Downloads a missing file into the store.
+
+    The download goes to a temporary name and is checked against the sha256
+    prefix in the url file name. Its checksum is added to the manifest before
+    the file is renamed to its final name, so a stored file always has a
+    manifest entry. Runs under the store lock: concurrent processes download
+    a file once.
+    """
+    path = local_path(url)
+    with store_lock():
+        if not os.path.exists(path):
+            match = HASH_REGEX.search(os.path.basename(path))
+            tmp = path + '.part'
+            torch.hub.download_url_to_file(url, tmp, hash_prefix=match.group(1) if match else None)
+            manifest = read_manifest()
+            manifest[os.path.basename(path)] = sha256sum(tmp)
+            write_manifest(manifest)
+            os.replace(tmp, path)
+    return path
+
+
+def load_url(url):
+    """Replacement for model_zoo.load_url backed by the local weight store
+    (Path.weights_dir()).
+
+    A stored file is checked against the manifest and loaded without touching
+    the network. Missing files are downloaded into the store, unless
+    DEEPLAB_OFFLINE is set, in which case a FileNotFoundError names the file
+    to copy there together with the manifest.
+    """
+    path = local_path(url)
+    if not os.path.exists(path):
+        if os.environ.get('DEEPLAB_OFFLINE'):
+            raise FileNotFoundError('{} is not in the weight store, fetch it on a machine with network '
+                                    'access (python -m modeling.backbone.weights --fetch) and copy the '
+                                    'store'.format(path))
+        fetch(url)
+    verify(path)
+    return torch.load(path, map_location='cpu')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the local store of pretrained backbone weights")
+    parser.add_argument('--fetch', action='store_true', default=False,
+                        help='download the missing weights into the store')
+    parser.add_argument('--record', action='store_true', default=False,
+                        help='record the checksums of weights copied into the store by hand')
+    parser.add_argument('--backbones', type=str, nargs='+', default=sorted(PRETRAINED_URLS.keys()),
+                        choices=sorted(PRETRAINED_URLS.keys()))
+    args = parser.parse_args()
+
+    failed = False
+    for backbone in args.backbones:
+        url = PRETRAINED_URLS[backbone]
+        path = local_path(url)
+        try:
+            if args.fetch:
+                fetch(url)
+            if not os.path.exists(path):
+                raise FileNotFoundError('missing')
+            if args.record:
+                record(path)
+            verify(path)
+            status = 'ok'
+        except Exception as e:
+            failed = True
+            status = str(e)
+        print('{:<10} {:<60} {}'.format(backbone, path, status))
+    if failed:
+        raise SystemExit(1)
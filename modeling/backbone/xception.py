@@ -2,8 +2,9 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.model_zoo as model_zoo
 from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
+from modeling.backbone.inflate import inflate_input_channels
+from modeling.backbone.weights import PRETRAINED_URLS, load_url
 
 def fixed_padding(inputs, kernel_size, dilation):
     kernel_size_effective = kernel_size + (kernel_size - 1) * (dilation - 1)
@@ -96,7 +97,7 @@ class AlignedXception(nn.Module):
     Modified Alighed Xception
     """
     def __init__(self, output_stride, BatchNorm,
-                 pretrained=True):
+                 pretrained=True, depth=False):
         super(AlignedXception, self).__init__()
 
         if output_stride == 16:
@@ -112,7 +113,7 @@ class AlignedXception(nn.Module):
 
 
         # Entry flow
-        self.conv1 = nn.Conv2d(3, 32, 3, stride=2, padding=1, bias=False)
+        self.conv1 = nn.Conv2d(4 if depth else 3, 32, 3, stride=2, padding=1, bias=False)
         self.bn1 = BatchNorm(32)
         self.relu = nn.ReLU(inplace=True)
 
@@ -245,7 +246,8 @@ class AlignedXception(nn.Module):
 
 
     def _load_pretrained_model(self):
-        pretrain_dict = model_zoo.load_url('http://data.lip6.fr/cadene/pretrainedmodels/xception-b5690688.pth')
+        pretrain_dict = load_url(PRETRAINED_URLS['xception'])
+        inflate_input_channels(pretrain_dict, 'conv1.weight', self.conv1.in_channels)
         model_dict = {}
         state_dict = self.state_dict()
 
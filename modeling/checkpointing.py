@@ -0,0 +1,53 @@
+import contextlib
+import torch
+import torch.nn as nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+
+# none:  keep every activation
+# layer: keep only the input of each checkpointed stage, recompute the stage in backward
+# block: as layer, but residual stages are split into one segment per block, so
+#        that only one block is recomputed and held at a time during backward
+GRANULARITIES = ['none', 'layer', 'block']
+
+
+@contextlib.contextmanager
+def _frozen_running_stats(module):
+    """The recomputation in backward runs the BN layers in training mode a
+    second time; momentum 0 keeps it from updating the running statistics."""
+    bns = [m for m in module.modules() if isinstance(m, _BatchNorm)]
+    state = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(bns, state):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _checkpoint(module, x):
+    return checkpoint(module, x, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), _frozen_running_stats(module)))
+
+
+def _is_residual_stage(module):
+    return isinstance(module, nn.Sequential) and all(hasattr(m, 'downsample') for m in module)
+
+
+def run(module, x, granularity='none'):
+    """Applies module to x with the given activation checkpointing granularity.
+
+    Checkpointing only kicks in when gradients are being recorded, so eval
+    and no_grad forwards are unchanged.
+    """
+    if granularity == 'none' or not (module.training and torch.is_grad_enabled()):
+        return module(x)
+    if granularity == 'block' and _is_residual_stage(module):
+        for block in module:
+            x = _checkpoint(block, x)
+        return x
+    if granularity not in GRANULARITIES:
+        raise NotImplementedError(granularity)
+    return _checkpoint(module, x)
@@ -3,9 +3,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
+from modeling import checkpointing
 
 class Decoder(nn.Module):
-    def __init__(self, num_classes, backbone, BatchNorm):
+    def __init__(self, num_classes, backbone, BatchNorm, widths=None):
         super(Decoder, self).__init__()
         if backbone == 'resnet' or backbone == 'drn':
             low_level_inplanes = 256
@@ -16,24 +17,33 @@ class Decoder(nn.Module):
         else:
             raise NotImplementedError
 
+        # channel widths, smaller in pruned models (inference/prune.py)
+        widths = widths or {}
+        inplanes = widths.get('aspp_out', 256)
+        low_level_planes = widths.get('low_level', 48)
+        planes = widths.get('last_conv', [256, 256])
+
         # confidence related variables
         confidence_channels = 1
-        self.conv1 = nn.Conv2d(low_level_inplanes, 48, 1, bias=False)
-        self.bn1 = BatchNorm(48)
+        self.conv1 = nn.Conv2d(low_level_inplanes, low_level_planes, 1, bias=False)
+        self.bn1 = BatchNorm(low_level_planes)
         self.relu = nn.ReLU()
-        self.last_conv = nn.Sequential(nn.Conv2d(304, 256, kernel_size=3, stride=1, padding=1, bias=False),
-                                       BatchNorm(256),
+        self.last_conv = nn.Sequential(nn.Conv2d(inplanes + low_level_planes, planes[0], kernel_size=3, stride=1, padding=1, bias=False),
+                                       BatchNorm(planes[0]),
                                        nn.ReLU(),
                                        nn.Dropout(0.5),
-                                       nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1, bias=False),
-                                       BatchNorm(256),
+                                       nn.Conv2d(planes[0], planes[1], kernel_size=3, stride=1, padding=1, bias=False),
+                                       BatchNorm(planes[1]),
                                        nn.ReLU(),
                                        nn.Dropout(0.1))
 
-        self.diverge_conv_pred = nn.Conv2d(256, num_classes, kernel_size=1, stride=1)
+        # activation checkpointing of last_conv, see modeling/checkpointing.py
+        self.checkpointing = 'none'
+
+        self.diverge_conv_pred = nn.Conv2d(planes[1], num_classes, kernel_size=1, stride=1)
 
         # change related to uncertainty
-        self.diverge_conv_conf = nn.Conv2d(256, confidence_channels,
+        self.diverge_conv_conf = nn.Conv2d(planes[1], confidence_channels,
                                            kernel_size = 1, stride=1)
         self._init_weight()
 
@@ -45,7 +55,7 @@ class Decoder(nn.Module):
 
         x = F.interpolate(x, size=low_level_feat.size()[2:], mode='bilinear', align_corners=True)
         x = torch.cat((x, low_level_feat), dim=1)
-        x = self.last_conv(x)
+        x = checkpointing.run(self.last_conv, x, self.checkpointing)
         x_pred = self.diverge_conv_pred(x)
         # change related to uncertainty
         conf = self.diverge_conv_conf(x)
@@ -63,5 +73,5 @@ class Decoder(nn.Module):
                 m.weight.data.fill_(1)
                 m.bias.data.zero_()
 
-def build_decoder(num_classes, backbone, BatchNorm):
-    return Decoder(num_classes, backbone, BatchNorm)
+def build_decoder(num_classes, backbone, BatchNorm, widths=None):
+    return Decoder(num_classes, backbone, BatchNorm, widths)
@@ -7,10 +7,12 @@ from modeling.sync_batchnorm.batchnorm import SynchronizedBatchNorm2d
 from modeling.aspp import build_aspp
 from modeling.decoder import build_decoder
 from modeling.backbone import build_backbone
+from modeling.checkpointing import GRANULARITIES
 
 class DeepLab(nn.Module):
         def __init__(self, backbone='resnet', output_stride=16, num_classes=21,
-                                 sync_bn=True, freeze_bn=False, depth=False):
+                                 sync_bn=True, freeze_bn=False, depth=False, pretrained=True, widths=None,
+                                 aspp='dense'):
                 super(DeepLab, self).__init__()
                 if backbone == 'drn':
                         output_stride = 8
@@ -22,22 +24,47 @@ class DeepLab(nn.Module):
 
                 print("DeepLab constructor:", depth)
                 self.backbone = build_backbone(backbone, output_stride,
-                                               BatchNorm, depth)
-                self.aspp = build_aspp(backbone, output_stride, BatchNorm)
-                self.decoder = build_decoder(num_classes, backbone, BatchNorm)
+                                               BatchNorm, depth, pretrained)
+                # widths: ASPP and decoder channel widths of pruned models, see infer_widths
+                # aspp: 'dense' or depthwise 'separable' atrous branches
+                self.aspp = build_aspp(backbone, output_stride, BatchNorm, widths, aspp)
+                self.decoder = build_decoder(num_classes, backbone, BatchNorm, widths)
 
                 if freeze_bn:
                         self.freeze_bn()
 
-        def forward(self, input):
+        def forward(self, input, resolution='full', outputs=('x', 'conf')):
                 x, low_level_feat = self.backbone(input)
                 x = self.aspp(x)
                 # change related to uncertainty
                 x, conf = self.decoder(x, low_level_feat)
-                pre_conf = F.interpolate(x, size=input.size()[2:], mode='bilinear', align_corners=True)
+                return self.gate_and_upsample(x, conf, input.size()[2:], resolution, outputs)
+
+        def gate_and_upsample(self, x, conf, size, resolution='full', outputs=('x', 'conf')):
+                # decoder logits and confidence to the outputs of forward()
+                if resolution == 'decoder':
+                        # outputs stay at decoder (1/4) resolution, the loss
+                        # is computed against downsampled labels
+                        conf = torch.sigmoid(conf)
+                        return x*conf, conf, x
+                elif resolution == 'fused':
+                        # gating at decoder resolution and a single upsampling of
+                        # the requested outputs, no full res intermediates; conf is
+                        # upsampled as logits so that it matches the full mode
+                        maps = {'x': lambda: x*torch.sigmoid(conf), 'conf': lambda: conf, 'pre_conf': lambda: x}
+                        fused = torch.cat([maps[name]() for name in outputs], dim=1)
+                        fused = F.interpolate(fused, size=size, mode='bilinear', align_corners=True)
+                        fused = torch.split(fused, [1 if name == 'conf' else x.size(1) for name in outputs], dim=1)
+                        # indexed rather than iterated, so FX can trace it (inference/quantize.py)
+                        return tuple(torch.sigmoid(fused[i]) if name == 'conf' else fused[i]
+                                     for i, name in enumerate(outputs))
+                elif resolution != 'full':
+                        raise NotImplementedError
+
+                pre_conf = F.interpolate(x, size=size, mode='bilinear', align_corners=True)
 
                 # change related to uncertainty
-                conf = F.interpolate(conf, size=input.size()[2:],
+                conf = F.interpolate(conf, size=size,
                                      mode='bilinear', align_corners=True)
 
                 # change related to uncertainty
@@ -46,6 +73,25 @@ class DeepLab(nn.Module):
 
                 return x, conf, pre_conf
 
+        def set_checkpointing(self, granularity):
+                # recompute backbone stages and the decoder head in backward instead
+                # of keeping their activations; granularity is one of
+                # modeling.checkpointing.GRANULARITIES
+                if granularity not in GRANULARITIES:
+                        raise NotImplementedError(granularity)
+                if not hasattr(self.backbone, 'checkpointing'):
+                        raise NotImplementedError('activation checkpointing is only supported '
+                                                  'for the drn and resnet backbones')
+                self.backbone.checkpointing = granularity
+                self.decoder.checkpointing = granularity
+
+        def set_memory_format(self, memory_format):
+                # NCHW (torch.contiguous_format) or NHWC (torch.channels_last)
+                # parameters and activations; a module attribute rather than a check
+                # of the activations, so the model stays FX traceable
+                self.aspp.memory_format = memory_format
+                return self.to(memory_format=memory_format)
+
         def freeze_bn(self):
                 for m in self.modules():
                         if isinstance(m, SynchronizedBatchNorm2d):
@@ -74,6 +120,20 @@ class DeepLab(nn.Module):
                                                         yield p
 
 
+def infer_widths(state_dict):
+        """ASPP and decoder channel widths of a (possibly pruned) DeepLab state dict."""
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+        # separable branches (modeling.aspp.separable_state_dict) end in a pointwise conv
+        branch = lambda i: state_dict.get('aspp.aspp{}.atrous_conv.weight'.format(i),
+                                          state_dict.get('aspp.aspp{}.atrous_conv.pointwise.weight'.format(i)))
+        return {'aspp': [branch(i).shape[0] for i in range(1, 5)] +
+                        [state_dict['aspp.global_avg_pool.1.weight'].shape[0]],
+                'aspp_out': state_dict['aspp.conv1.weight'].shape[0],
+                'low_level': state_dict['decoder.conv1.weight'].shape[0],
+                'last_conv': [state_dict['decoder.last_conv.0.weight'].shape[0],
+                              state_dict['decoder.last_conv.4.weight'].shape[0]]}
+
+
 if __name__ == "__main__":
         model = DeepLab(backbone='drn', output_stride=16,num_classes=3,
                         depth=True)
@@ -103,3 +163,4 @@ if __name__ == "__main__":
         f=open("/home/aditya/small_obstacle_ws/Small_Obstacle_Segmentation/deeplab-small_obs-depth_input_uncertainty.pth","wb")
         torch.save(checkpoint,f)
         f.close()
+
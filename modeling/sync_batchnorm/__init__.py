@@ -8,5 +8,6 @@
 # https://github.com/vacancy/Synchronized-BatchNorm-PyTorch
 # Distributed under MIT License.
 
-from .batchnorm import SynchronizedBatchNorm1d, SynchronizedBatchNorm2d, SynchronizedBatchNorm3d
+from .batchnorm import SynchronizedBatchNorm1d, SynchronizedBatchNorm2d, SynchronizedBatchNorm3d, revert_sync_batchnorm, \
+    use_process_group
 from .replicate import DataParallelWithCallback, patch_replication_callback
\ No newline at end of file
@@ -11,6 +11,7 @@
 import collections
 
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 
 from torch.nn.modules.batchnorm import _BatchNorm
@@ -18,7 +19,8 @@ from torch.nn.parallel._functions import ReduceAddCoalesced, Broadcast
 
 from .comm import SyncMaster
 
-__all__ = ['SynchronizedBatchNorm1d', 'SynchronizedBatchNorm2d', 'SynchronizedBatchNorm3d']
+__all__ = ['SynchronizedBatchNorm1d', 'SynchronizedBatchNorm2d', 'SynchronizedBatchNorm3d', 'revert_sync_batchnorm',
+           'use_process_group']
 
 
 def _sum_ft(tensor):
@@ -35,6 +37,68 @@ _ChildMessage = collections.namedtuple('_ChildMessage', ['sum', 'ssum', 'sum_siz
 _MasterMessage = collections.namedtuple('_MasterMessage', ['sum', 'inv_std'])
 
 
+class _DistributedBatchNorm(torch.autograd.Function):
+    """Batch norm with the statistics of all ranks of a process group.
+
+    Forward all-gathers the per-rank mean, variance and size and combines
+    them (Chan et al.), backward all-reduces the sums of the output gradient
+    and of its product with the centered input. The elementwise work runs in
+    the fused F.batch_norm kernels, and only the input and the statistics are
+    saved, as for F.batch_norm.
+    """
+
+    @staticmethod
+    def forward(ctx, input, weight, bias, eps, group):
+        num_features = input.size(1)
+        dims = [0] + list(range(2, input.dim()))
+        # fp32 statistics also under autocast
+        x = input.float() if input.dtype in (torch.float16, torch.bfloat16) else input
+        var, mean = torch.var_mean(x, dims, unbiased=False)
+        local = torch.cat([mean, var, x.new_tensor([x.numel() // num_features])])
+        gathered = [torch.empty_like(local) for _ in range(dist.get_world_size(group))]
+        dist.all_gather(gathered, local, group=group)
+        gathered = torch.stack(gathered)
+        means, variances, counts = gathered[:, :num_features], gathered[:, num_features:-1], gathered[:, -1:]
+        size = int(counts.sum().item())
+        assert size > 1, 'BatchNorm computes unbiased standard-deviation, which requires size > 1.'
+        mean = (means * counts).sum(0) / size
+        var = ((variances + (means - mean) ** 2) * counts).sum(0) / size
+
+        # eps added as in F.batch_norm (not clamped), so a single rank trains exactly as plain BN
+        output = F.batch_norm(x, mean, var, weight, bias, False, 0.0, eps)
+        ctx.save_for_backward(input, weight, mean, var)
+        ctx.eps, ctx.size, ctx.group = eps, size, group
+        unbiased_var = var * size / (size - 1)
+        ctx.mark_non_differentiable(mean, unbiased_var)
+        return output, mean, unbiased_var
+
+    @staticmethod
+    def backward(ctx, grad_output, _mean, _var):
+        input, weight, mean, var = ctx.saved_tensors
+        shape = (1, -1) + (1,) * (input.dim() - 2)
+        x = input.float() if input.dtype in (torch.float16, torch.bfloat16) else input
+        invstd = (var + ctx.eps).rsqrt()
+        scale = invstd if weight is None else invstd * weight
+        # the backward for fixed statistics: grad_output * scale and the local
+        # sums of grad_output * (x - mean) * invstd and of grad_output
+        grad_input, grad_weight, grad_bias = torch.ops.aten.native_batch_norm_backward(
+            grad_output.contiguous(), x, torch.ones_like(mean) if weight is None else weight, mean, var,
+            None, None, False, ctx.eps, [ctx.needs_input_grad[0], True, True])
+
+        if ctx.needs_input_grad[0]:
+            # plus the gradient through the statistics, which depend on the inputs of all ranks
+            sums = torch.cat([grad_bias, grad_weight / invstd])
+            dist.all_reduce(sums, group=ctx.group)
+            mean_dy, mean_dy_xmu = sums[:mean.numel()] / ctx.size, sums[mean.numel():] / ctx.size
+            a = -invstd * invstd * mean_dy_xmu * scale
+            b = -mean_dy * scale - mean * a
+            grad_input = grad_input.addcmul_(x, a.view(shape)).add_(b.view(shape)).to(input.dtype)
+        # local parameter gradients, DistributedDataParallel averages them
+        if weight is None:
+            grad_weight = None
+        return grad_input, grad_weight, grad_bias, None, None
+
+
 class _SynchronizedBatchNorm(_BatchNorm):
     def __init__(self, num_features, eps=1e-5, momentum=0.1, affine=True):
         super(_SynchronizedBatchNorm, self).__init__(num_features, eps=eps, momentum=momentum, affine=affine)
@@ -45,7 +109,14 @@ class _SynchronizedBatchNorm(_BatchNorm):
         self._parallel_id = None
         self._slave_pipe = None
 
+        # Set by use_process_group: reduce over the ranks of a torch.distributed group instead.
+        self._is_distributed = False
+        self._process_group = None
+
     def forward(self, input):
+        if self._is_distributed and self.training and dist.is_initialized():
+            return self._distributed_forward(input)
+
         # If it is not parallel computation or is in evaluation mode, use PyTorch's implementation.
         if not (self._is_parallel and self.training):
             return F.batch_norm(
@@ -77,6 +148,13 @@ class _SynchronizedBatchNorm(_BatchNorm):
         # Reshape it.
         return output.view(input_shape)
 
+    def _distributed_forward(self, input):
+        output, mean, var = _DistributedBatchNorm.apply(input, self.weight, self.bias, self.eps,
+                                                        self._process_group or dist.group.WORLD)
+        self.running_mean = (1 - self.momentum) * self.running_mean + self.momentum * mean
+        self.running_var = (1 - self.momentum) * self.running_var + self.momentum * var
+        return output
+
     def __data_parallel_replicate__(self, ctx, copy_id):
         self._is_parallel = True
         self._parallel_id = copy_id
@@ -279,4 +357,51 @@ class SynchronizedBatchNorm3d(_SynchronizedBatchNorm):
         if input.dim() != 5:
             raise ValueError('expected 5D input (got {}D input)'
                              .format(input.dim()))
-        super(SynchronizedBatchNorm3d, self)._check_input_dim(input)
\ No newline at end of file
+        super(SynchronizedBatchNorm3d, self)._check_input_dim(input)
+
+def revert_sync_batchnorm(module):
+    """Replace all SynchronizedBatchNorm*d layers of a module by the plain PyTorch
+    BatchNorm*d layers, keeping parameters and running statistics. The thread
+    based sync master cannot be copied, traced or exported, so this is needed
+    before deepcopy, TorchScript or ONNX export.
+
+    Examples:
+        >>> m = revert_sync_batchnorm(DeepLab(sync_bn=True))
+    """
+    mod = module
+    for sync_cls, cls in [(SynchronizedBatchNorm1d, torch.nn.BatchNorm1d),
+                          (SynchronizedBatchNorm2d, torch.nn.BatchNorm2d),
+                          (SynchronizedBatchNorm3d, torch.nn.BatchNorm3d)]:
+        if isinstance(module, sync_cls):
+            mod = cls(module.num_features, module.eps, module.momentum, module.affine)
+            mod.running_mean = module.running_mean
+            mod.running_var = module.running_var
+            mod.num_batches_tracked = module.num_batches_tracked
+            if module.affine:
+                mod.weight = module.weight
+                mod.bias = module.bias
+            mod.train(module.training)
+
+    for name, child in module.named_children():
+        mod.add_module(name, revert_sync_batchnorm(child))
+
+    return mod
+
+
+def use_process_group(module, process_group=None):
+    """Switch all SynchronizedBatchNorm*d layers of a module from the thread based
+    DataParallel sync to batch statistics over the ranks of a
+    torch.distributed process group (default: the whole world), for
+    DistributedDataParallel training with any backend, gloo on CPU included.
+    Parameters and buffers are unchanged, so are the state dict keys. Layers
+    run as plain BatchNorm in eval mode or without an initialized process group.
+
+    Examples:
+        >>> dist.init_process_group('gloo')
+        >>> m = DistributedDataParallel(use_process_group(DeepLab(sync_bn=True)))
+    """
+    for m in module.modules():
+        if isinstance(m, _SynchronizedBatchNorm):
+            m._is_distributed = True
+            m._process_group = process_group
+    return module
@@ -1,3 +1,6 @@
+import os
+
+
 class Path(object):
     @staticmethod
     def db_root_dir(dataset):
@@ -16,3 +19,8 @@ class Path(object):
         else:
             print('Dataset {} not available.'.format(dataset))
             raise NotImplementedError
+
+    @staticmethod
+    def weights_dir():
+        # local store of the pretrained backbone weights, see modeling/backbone/weights.py
+        return os.environ.get('DEEPLAB_WEIGHTS_DIR', '/content/pretrained_weights/')
@@ -1,32 +1,61 @@
 import argparse
+import contextlib
+import itertools
+import math
+import random
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import os
 import numpy as np
 from tqdm import tqdm
 from mypath import Path
 from dataloaders import make_data_loader
-from modeling.sync_batchnorm.replicate import patch_replication_callback
+from modeling.sync_batchnorm import patch_replication_callback, use_process_group
 from modeling.deeplab import *
+from modeling.backbone import weights
 from utils.loss import SegmentationLosses
 from utils.calculate_weights import calculate_weights_batch
 from utils.lr_scheduler import LR_Scheduler
 from utils.saver import Saver
-from utils.summaries import TensorboardSummary
+from utils.summaries import TensorboardSummary, NullSummaryWriter
 from utils.metrics import Evaluator
+from utils.distillation import TeacherCache, load_teacher, teacher_input, resize
+from inference.tta import TestTimeAugmentation
 import utils.helpers as HLP
 
 class Trainer(object):
         def __init__(self, args):
                 self.args = args
+                # in distributed training only rank 0 writes checkpoints and logs
+                self.is_main = args.rank == 0
 
                 # Define Saver
-                self.saver = Saver(args)
-                self.saver.save_experiment_config()
+                self.saver = None
+                if self.is_main:
+                        self.saver = Saver(args, max_pending=args.checkpoint_queue)
+                        self.saver.save_experiment_config()
                 self.nclass = 10
                 # Define Tensorboard Summary
-                self.summary = TensorboardSummary(self.saver.experiment_dir)
-                self.writer = self.summary.create_summary()
+                if self.is_main:
+                        self.summary = TensorboardSummary(self.saver.experiment_dir)
+                        self.writer = self.summary.create_summary()
+                else:
+                        self.summary, self.writer = None, NullSummaryWriter()
+
+                # pruned checkpoints (inference/prune.py) carry smaller ASPP/decoder widths
+                widths = None
+                if args.resume is not None and os.path.isfile(args.resume):
+                        widths = infer_widths(torch.load(args.resume, map_location='cpu')['state_dict'])
+
+                if args.distributed:
+                        # rank 0 fills the weight store, the other ranks wait for it and only read it
+                        if self.is_main and not os.environ.get('DEEPLAB_OFFLINE'):
+                                weights.fetch(weights.PRETRAINED_URLS[args.backbone])
+                        dist.barrier()
 
                 # Define Dataloader
                 kwargs = {'num_workers': args.workers, 'pin_memory': True}
@@ -49,7 +78,9 @@ class Trainer(object):
                                                     output_stride=args.out_stride,
                                                     sync_bn=args.sync_bn,
                                                     freeze_bn=args.freeze_bn,
-                                    depth=args.depth)
+                                    depth=args.depth,
+                                    widths=widths,
+                                    aspp=args.aspp)
                 else:
                     train_imgs, train_labels = HLP.get_ImagesAndLabels_contextnet(Path.db_root_dir(args.dataset),
                                                        num_samples=args.num_samples)
@@ -79,7 +110,54 @@ class Trainer(object):
                                                     output_stride=args.out_stride,
                                                     sync_bn=args.sync_bn,
                                                     freeze_bn=args.freeze_bn,
-                                    depth=args.depth)
+                                    depth=args.depth,
+                                    widths=widths,
+                                    aspp=args.aspp)
+
+                if args.distributed:
+                        # every rank loads its own shard of each split; the train shards are
+                        # padded to equal length, the val/test shards are not, so that no
+                        # frame is counted twice in the all-reduced metrics
+                        self.train_loader = DataLoader(self.train_loader.dataset, batch_size=self.args.batch_size,
+                                                       sampler=DistributedSampler(self.train_loader.dataset,
+                                                                                  shuffle=True, seed=args.seed))
+                        self.val_loader, self.test_loader = [
+                                DataLoader(loader.dataset, batch_size=self.args.batch_size,
+                                           sampler=range(args.rank, len(loader.dataset), args.world_size))
+                                for loader in (self.val_loader, self.test_loader)]
+
+                if args.channels_last:
+                        model = model.set_memory_format(torch.channels_last)
+                if args.checkpoint_activations != 'none':
+                        model.set_checkpointing(args.checkpoint_activations)
+
+                # Define teacher for distillation
+                self.teacher = self.teacher_cache = None
+                if args.teacher is not None:
+                        self.teacher, self.teacher_config = load_teacher(args.teacher, 'cuda' if args.cuda else 'cpu')
+                        if self.teacher_config['num_classes'] != self.nclass:
+                                raise ValueError('Teacher has {} classes, student {}'.format(
+                                        self.teacher_config['num_classes'], self.nclass))
+                        if self.teacher_config['depth'] and not args.depth:
+                                raise ValueError('An RGB-D teacher needs an RGB-D student (--depth)')
+                        if args.channels_last:
+                                self.teacher = self.teacher.set_memory_format(torch.channels_last)
+                        if args.teacher_cache is not None:
+                                # rank 0 fills the cache, the other ranks wait for it
+                                if self.is_main:
+                                        self.teacher_cache = TeacherCache(args.teacher_cache, args.teacher)
+                                        if self.teacher_config['depth']:
+                                                frames = HLP.LNFGeneratorTorch(rgb_path=train_imgs, disparity_path=train_disp,
+                                                                               mask_path=train_labels, flag='merge', split='test')
+                                        else:
+                                                frames = HLP.LNFGeneratorTorch(rgb_path=train_imgs, mask_path=train_labels,
+                                                                               flag='context', split='test')
+                                        self.teacher_cache.build(self.teacher, frames, args.batch_size,
+                                                                 'cuda' if args.cuda else 'cpu')
+                                if args.distributed:
+                                        dist.barrier()
+                                if not self.is_main:
+                                        self.teacher_cache = TeacherCache(args.teacher_cache, args.teacher)
 
                 train_params = [{'params': model.get_1x_lr_params(), 'lr': args.lr},
                                                 {'params': model.get_10x_lr_params(), 'lr': args.lr * 10}]
@@ -106,29 +184,44 @@ class Trainer(object):
 
                 # Define Evaluator
                 self.evaluator = Evaluator(self.nclass)
-                # Define lr scheduler
+                # Define lr scheduler, stepped once per optimizer step
+                self.steps_per_epoch = int(math.ceil(len(self.train_loader) / float(args.accum_steps)))
                 self.scheduler = LR_Scheduler(args.lr_scheduler, args.lr,
-                                                                                        args.epochs, len(self.train_loader))
+                                                                                        args.epochs, self.steps_per_epoch)
 
                 # write the graph
                 tensor = torch.zeros([2, 3, 512, 512])
                 self.writer.add_graph(model, tensor)
 
                 # Using cuda
-                if args.cuda:
+                if args.distributed:
+                        if args.cuda:
+                                self.model = self.model.cuda()
+                        if args.sync_bn:
+                                # batch statistics over the ranks instead of the DataParallel replicas
+                                use_process_group(self.model)
+                        self.model = DistributedDataParallel(self.model,
+                                                             device_ids=[args.local_rank] if args.cuda else None)
+                elif args.cuda:
                         self.model = torch.nn.DataParallel(self.model, device_ids=self.args.gpu_ids)
                         patch_replication_callback(self.model)
                         self.model = self.model.cuda()
 
+                # flip/multi-scale test-time augmentation in validation and test
+                self.tta = None
+                if args.tta_scales is not None or args.tta_flip:
+                        self.tta = TestTimeAugmentation(self.model, args.tta_scales or [1.0], args.tta_flip,
+                                                        args.tta_batch)
+
                 # Resuming checkpoint
                 self.best_pred = 0.0
                 if args.resume is not None:
                         if not os.path.isfile(args.resume):
                                 raise RuntimeError("=> no checkpoint found at '{}'" .format(args.resume))
 
-                        checkpoint = torch.load(args.resume)
+                        checkpoint = torch.load(args.resume, map_location='cpu')
                         args.start_epoch = checkpoint['epoch']
-                        if args.cuda:
+                        if args.cuda or args.distributed:
                                 self.model.module.load_state_dict(checkpoint['state_dict'])
                         else:
                                 self.model.load_state_dict(checkpoint['state_dict'])
@@ -141,33 +234,93 @@ class Trainer(object):
                 if args.ft:
                         args.start_epoch = 0
 
+        def autocast(self):
+                return torch.autocast(device_type='cuda' if self.args.cuda else 'cpu',
+                                      dtype=torch.bfloat16, enabled=self.args.bf16)
+
+        def teacher_targets(self, sample, image, size):
+                """Teacher logits and confidence for a training batch, from the cache or a no_grad forward."""
+                if self.teacher_cache is not None:
+                        paths = [self.train_loader.dataset._x_rgb[i] for i in sample['index'].tolist()]
+                        x, conf = self.teacher_cache.targets(sample, paths, size)
+                        return x.to(image.device), conf.to(image.device)
+                with torch.no_grad():
+                        with self.autocast():
+                                x, conf, _ = self.teacher(teacher_input(image, self.args.depth, self.teacher_config['depth']),
+                                                          resolution=self.args.loss_res)
+                return resize(x.float(), size), resize(conf.float(), size)
+
         def training(self, epoch):
                 train_loss = 0.0
                 self.model.train()
                 self.evaluator.reset()
-                tbar = tqdm(self.train_loader, desc='training')
-                num_img_tr = len(self.train_loader)
+                if self.args.distributed:
+                        self.train_loader.sampler.set_epoch(epoch)
+                tbar = tqdm(self.train_loader, desc='training', disable=not self.is_main)
+                num_steps = self.steps_per_epoch
                 recall=0.0                      # Just for small obstacle
                 precision=0.0
                 idr = 0
-                for i, sample in enumerate(tbar):
-                        image, target = sample['image'], sample['label']
-                        if self.args.cuda:
-                                image, target = image.cuda(), target.cuda()
-
-                        self.scheduler(self.optimizer, i, epoch, self.best_pred)
+                batches = iter(tbar)
+                for step in range(num_steps):
+                        # one optimizer step over accum_steps micro-batches
+                        samples = list(itertools.islice(batches, self.args.accum_steps))
+                        self.scheduler(self.optimizer, step, epoch, self.best_pred)
                         self.optimizer.zero_grad()
-                        output, conf, pre_conf = self.model(image)
-                        loss = self.criterion.CrossEntropyLoss(output,target,weight=torch.from_numpy(calculate_weights_batch(sample,self.nclass).astype(np.float32)))
-                        loss.backward()
+                        # class weights of the whole effective batch
+                        weight = torch.from_numpy(calculate_weights_batch(
+                                {'label': torch.cat([sample['label'] for sample in samples])}, self.nclass).astype(np.float32))
+                        total = float(sum(sample['label'].size(0) for sample in samples))
+                        step_loss = 0.0
+                        for k, sample in enumerate(samples):
+                                image, target = sample['image'], sample['label']
+                                if self.args.channels_last:
+                                        image = image.contiguous(memory_format=torch.channels_last)
+                                if self.args.cuda:
+                                        image, target = image.cuda(), target.cuda()
+
+                                # DistributedDataParallel reduces the gradients in the last backward only
+                                sync = not self.args.distributed or k == len(samples) - 1
+                                with self.model.no_sync() if not sync else contextlib.nullcontext():
+                                        with self.autocast():
+                                                output, conf, pre_conf = self.model(image, resolution=self.args.loss_res)
+                                        # loss and metrics stay in fp32 under autocast
+                                        output, conf = output.float(), conf.float()
+                                        if self.args.loss_res == 'decoder':
+                                                loss = self.criterion.LowResCrossEntropyLoss(output, target, weight=weight,
+                                                                                             boundary_weight=self.args.boundary_weight)
+                                        else:
+                                                loss = self.criterion.CrossEntropyLoss(output,target,weight=weight)
+                                        if self.teacher is not None:
+                                                teacher_output, teacher_conf = self.teacher_targets(sample, image, output.size()[2:])
+                                                loss = (1 - self.args.distill_alpha) * loss + self.args.distill_alpha * \
+                                                        self.criterion.DistillationLoss(output, conf, teacher_output, teacher_conf,
+                                                                                        self.args.distill_temperature)
+                                        # the losses average over pixels and divide by the batch size, so the
+                                        # effective batch loss is the sum of the micro-batch losses scaled by
+                                        # (n / total) ** 2 (exact up to the class weighted pixel average)
+                                        loss = loss * (image.size(0) / total) ** 2
+                                        loss.backward()
+                                step_loss += loss.item()
+
+                                if self.args.loss_res == 'decoder':
+                                        # full resolution maps only for metrics and visualization
+                                        with torch.no_grad():
+                                                output = F.interpolate(output, size=image.size()[2:], mode='bilinear', align_corners=True)
+                                                conf = F.interpolate(conf, size=image.size()[2:], mode='bilinear', align_corners=True)
+                                pred = output.data.cpu().numpy()
+                                pred = np.argmax(pred, axis=1)
+                                # Add batch sample into evaluator
+                                self.evaluator.add_batch(target.cpu().numpy(), pred)
+
                         self.optimizer.step()
-                        train_loss += loss.item()
-                        tbar.set_description('Train loss: %.3f' % (train_loss / (i + 1)))
-                        self.writer.add_scalar('loss/train_batch_loss', loss.item(), i + num_img_tr * epoch)
+                        train_loss += step_loss
+                        tbar.set_description('Train loss: %.3f' % (train_loss / (step + 1)))
+                        global_step = step + num_steps * epoch
+                        self.writer.add_scalar('loss/train_batch_loss', step_loss, global_step)
 
-                        # Show 10 * 3 inference results each epoch
-                        if i % (num_img_tr // 10) == 0:
-                                global_step = i + num_img_tr * epoch
+                        # Show 10 * 3 inference results each epoch, of the last micro-batch
+                        if step % max(num_steps // 10, 1) == 0 and self.is_main:
                                 if self.args.depth:
                                     self.summary.visualize_image(self.writer,
                                                                  self.args.dataset,
@@ -182,15 +335,11 @@ class Trainer(object):
                                                                  output, conf,
                                                                  global_step,
                                                                  flag='train')
-
-
-                        pred = output.data.cpu().numpy()
-                        target = target.cpu().numpy()
-                        pred = np.argmax(pred, axis=1)
-                        # Add batch sample into evaluator
-                        self.evaluator.add_batch(target, pred)
+                tbar.close()
 
                 # Fast test during the training
+                if self.args.distributed:
+                        self.evaluator.all_reduce(class_id=2)
                 Acc = self.evaluator.Pixel_Accuracy()
                 Acc_class = self.evaluator.Pixel_Accuracy_Class()
                 mIoU = self.evaluator.Mean_Intersection_over_Union()
@@ -209,7 +358,7 @@ class Trainer(object):
                 if idr is not None:
                     self.writer.add_scalar('metrics/train_idr_epoch', idr, epoch)
 
-                if self.args.no_val:
+                if self.args.no_val and self.is_main:
                         # save checkpoint every epoch
                         is_best = False
                         self.saver.save_checkpoint({
@@ -231,7 +380,7 @@ class Trainer(object):
 
                 self.model.eval()
                 self.evaluator.reset()
-                tbar = tqdm(loader, desc='validation')
+                tbar = tqdm(loader, desc='validation', disable=not self.is_main)
 
                 test_loss = 0.0
                 recall=0.0                      # Just for small obstacle
@@ -241,16 +390,22 @@ class Trainer(object):
 
                 for i, sample in enumerate(tbar):
                         image, target = sample['image'], sample['label']
+                        if self.args.channels_last:
+                                image = image.contiguous(memory_format=torch.channels_last)
                         if self.args.cuda:
                                 image, target = image.cuda(), target.cuda()
                         with torch.no_grad():
-                                x = self.model(image)
-                                output, conf = x[0], x[1]
+                                with self.autocast():
+                                        if self.tta is not None:
+                                                x = self.tta(image)
+                                        else:
+                                                x = self.model(image, resolution='fused')
+                                output, conf = x[0].float(), x[1].float()
                                 print(output.shape)
                                 loss = self.criterion.CrossEntropyLoss(output,target,weight=torch.from_numpy(calculate_weights_batch(sample,self.nclass).astype(np.float32)))
                                 test_loss += loss.item()
                         tbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-                        if i % (num_itr // 5) == 0:
+                        if i % max(num_itr // 5, 1) == 0 and self.is_main:
                                 global_step = i + num_itr * epoch
                                 if not self.args.depth:
                                     self.summary.visualize_image(self.writer,
@@ -273,6 +428,8 @@ class Trainer(object):
                         # Add batch sample into evaluator
                         self.evaluator.add_batch(target, pred)
                 # Fast test during the training
+                if self.args.distributed:
+                        self.evaluator.all_reduce(class_id=2)
                 Acc = self.evaluator.Pixel_Accuracy()
                 Acc_class = self.evaluator.Pixel_Accuracy_Class()
                 mIoU = self.evaluator.Mean_Intersection_over_Union()
@@ -299,18 +456,23 @@ class Trainer(object):
                 if new_pred > self.best_pred:
                         is_best = True
                         self.best_pred = new_pred
-                        self.saver.save_checkpoint({
-                                'epoch': epoch + 1,
-                                'state_dict': self.model.module.state_dict(),
-                                'optimizer': self.optimizer.state_dict(),
-                                'best_pred': self.best_pred,
-                        }, is_best)
+                        if self.is_main:
+                                self.saver.save_checkpoint({
+                                        'epoch': epoch + 1,
+                                        'state_dict': self.model.module.state_dict(),
+                                        'optimizer': self.optimizer.state_dict(),
+                                        'best_pred': self.best_pred,
+                                }, is_best)
 
 def main():
         parser = argparse.ArgumentParser(description="PyTorch DeeplabV3Plus Training")
         parser.add_argument('--backbone', type=str, default='drn',
                                                 choices=['resnet', 'xception', 'drn', 'mobilenet'],
                                                 help='backbone name (default: drn)')
+        parser.add_argument('--aspp', type=str, default='dense',
+                                                choices=['dense', 'separable'],
+                                                help='ASPP atrous branches, separable for depthwise + pointwise \
+                                                                convs, see inference/separable.py (default: dense)')
         parser.add_argument('--out-stride', type=int, default=16,
                                                 help='network output stride (default: 8)')
         parser.add_argument('--dataset', type=str, default='small_obstacle',
@@ -331,6 +493,12 @@ def main():
         parser.add_argument('--loss-type', type=str, default='ce',
                                                 choices=['ce', 'focal'],
                                                 help='loss func type (default: ce)')
+        parser.add_argument('--loss-res', type=str, default='full',
+                                                choices=['full', 'decoder'],
+                                                help='resolution the training loss is computed at (default: full)')
+        parser.add_argument('--boundary-weight', type=float, default=0.0,
+                                                help='weight of the full resolution boundary term \
+                                                                with --loss-res decoder (default: 0)')
         # training hyper params
         parser.add_argument('--epochs', type=int, default=None, metavar='N',
                                                 help='number of epochs to train (default: auto)')
@@ -339,6 +507,9 @@ def main():
         parser.add_argument('--batch-size', type=int, default=8,
                                                 metavar='N', help='input batch size for \
                                                                 training (default: auto)')
+        parser.add_argument('--accum-steps', type=int, default=1, metavar='K',
+                                                help='micro-batches of --batch-size accumulated per \
+                                                                optimizer step (default: 1)')
         parser.add_argument('--test-batch-size', type=int, default=None,
                                                 metavar='N', help='input batch size for \
                                                                 testing (default: auto)')
@@ -377,12 +548,47 @@ def main():
                                                 help='evaluuation interval (default: 1)')
         parser.add_argument('--no-val', action='store_true', default=False,
                                                 help='skip validation during training')
+        parser.add_argument('--checkpoint-queue', type=int, default=1,
+                                                help='checkpoints waiting for the background writer before \
+                                                                training blocks, 0 to write in the training loop (default: 1)')
 
         parser.add_argument('--mode',type=str,help='options=train/val/test')
 
         parser.add_argument('--num_samples', type=int, default=None)
         parser.add_argument('--depth', action='store_true', default=False,
                             help='expects RGB and depth as inputs')
+        parser.add_argument('--bf16', action='store_true', default=False,
+                            help='run the model forward under bfloat16 autocast, \
+                            loss and metrics stay in fp32')
+        parser.add_argument('--checkpoint-activations', type=str, default='none',
+                            choices=['none', 'layer', 'block'],
+                            help='recompute drn/resnet stages and the decoder head in backward \
+                            instead of storing their activations (default: none)')
+        parser.add_argument('--teacher', type=str, default=None,
+                            help='checkpoint of a frozen teacher to distill from, e.g. a drn model \
+                            for a mobilenet student (default: none)')
+        parser.add_argument('--distill-alpha', type=float, default=0.5,
+                            help='weight of the distillation loss, the cross entropy gets 1 - alpha (default: 0.5)')
+        parser.add_argument('--distill-temperature', type=float, default=2.0,
+                            help='softmax temperature of the distillation loss (default: 2)')
+        parser.add_argument('--teacher-cache', type=str, default=None,
+                            help='directory to store the teacher outputs of the training frames in, \
+                            later runs with the same teacher read them instead of running it')
+        parser.add_argument('--channels-last', action='store_true', default=False,
+                            help='run the model and its inputs in NHWC memory format')
+        parser.add_argument('--tta-scales', type=float, nargs='+', default=None,
+                            help='input scales of the test-time augmentation in validation/test \
+                            (default: none)')
+        parser.add_argument('--tta-flip', action='store_true', default=False,
+                            help='add horizontally flipped views to the test-time augmentation')
+        parser.add_argument('--tta-batch', type=str, default='scale', choices=['scale', 'all', 'none'],
+                            help='views run in one forward: per scale, all views on a padded \
+                            canvas, or one per view (default: scale)')
+        parser.add_argument('--distributed', action='store_true', default=False,
+                            help='DistributedDataParallel training with one process per GPU (or per CPU \
+                            process with gloo), launched by torchrun, e.g. torchrun --nproc_per_node 2 train.py')
+        parser.add_argument('--dist-backend', type=str, default=None, choices=['nccl', 'gloo'],
+                            help='torch.distributed backend (default: nccl with cuda, gloo without)')
         parser.add_argument('--debug', action='store_true', default=False,
                             help='no unnecessarily logging')
         parser.add_argument('--logsFlag', type=str, required=True)
@@ -395,8 +601,20 @@ def main():
                 except ValueError:
                         raise ValueError('Argument --gpu_ids must be a comma-separated list of integers only')
 
+        args.rank, args.world_size, args.local_rank = 0, 1, 0
+        if args.distributed:
+                # RANK, WORLD_SIZE, LOCAL_RANK and MASTER_ADDR/PORT are set by torchrun
+                args.rank, args.world_size = int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
+                args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+                if args.cuda:
+                        torch.cuda.set_device(args.local_rank)
+                        args.gpu_ids = [args.local_rank]
+                dist.init_process_group(args.dist_backend or ('nccl' if args.cuda else 'gloo'))
+                # the file lists are shuffled with random, every rank needs the same order
+                random.seed(args.seed)
+
         if args.sync_bn is None:
-                if args.cuda and len(args.gpu_ids) > 1:
+                if args.world_size > 1 or (args.cuda and len(args.gpu_ids) > 1):
                         args.sync_bn = True
                 else:
                         args.sync_bn = False
@@ -425,7 +643,7 @@ def main():
                         'small_obstacle': 0.01,
                         'lnf': 0.01
                 }
-                args.lr = lrs[args.dataset.lower()] / (4 * len(args.gpu_ids)) * args.batch_size
+                args.lr = lrs[args.dataset.lower()] / (4 * len(args.gpu_ids)) * args.batch_size * args.accum_steps
 
 
         if args.checkname is None:
@@ -449,6 +667,10 @@ def main():
                         break
 
         trainer.writer.close()
+        if trainer.saver is not None:
+                trainer.saver.close()
+        if args.distributed:
+                dist.destroy_process_group()
 
 if __name__ == "__main__":
         main()
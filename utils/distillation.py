@@ -0,0 +1,96 @@
+import hashlib
+import os
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+from inference.predictor import build_model, RGB_MEAN, RGB_STD, RGBD_MEAN, RGBD_STD
+
+
+def load_teacher(checkpoint, device='cpu'):
+    """Frozen eval mode teacher and its config (see inference.predictor.infer_config)."""
+    model, config = build_model(checkpoint, device=device)
+    for p in model.parameters():
+        p.requires_grad = False
+    return model, config
+
+
+def teacher_input(image, depth, teacher_depth):
+    """Student input batch as expected by the teacher.
+
+    An RGB teacher of an RGB-D student gets the RGB channels, renormalized
+    from the RGB-D to the RGB statistics of the data loader.
+    """
+    if teacher_depth == depth:
+        return image
+    if teacher_depth:
+        raise ValueError('An RGB-D teacher needs an RGB-D student (--depth)')
+    rgbd_mean, rgbd_std, rgb_mean, rgb_std = (image.new_tensor(v).view(1, -1, 1, 1) for v in
+                                              (RGBD_MEAN[:3], RGBD_STD[:3], RGB_MEAN, RGB_STD))
+    return (image[:, :3] * rgbd_std + rgbd_mean - rgb_mean) / rgb_std
+
+
+def resize(maps, size):
+    if maps.size()[2:] == size:
+        return maps
+    return F.interpolate(maps, size=size, mode='bilinear', align_corners=True)
+
+
+class TeacherCache(object):
+    """Teacher outputs of the training frames, stored on disk.
+
+    The teacher runs once per frame on the un-augmented road crop (the test
+    transform). Its gated logits and confidence are stored in fp16 at decoder
+    resolution, one file per frame named after the hash of the image path.
+    targets() replays the flip and crop that the training transforms recorded
+    in a sample, so student runs on a filled cache need no teacher forward.
+    A cache directory belongs to one teacher checkpoint.
+    """
+    def __init__(self, cache_dir, teacher_checkpoint):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        stat = os.stat(teacher_checkpoint)
+        owner = '{} {} {}\n'.format(os.path.abspath(teacher_checkpoint), stat.st_size, int(stat.st_mtime))
+        owner_path = os.path.join(cache_dir, 'TEACHER')
+        if os.path.exists(owner_path):
+            with open(owner_path) as f:
+                if f.read() != owner:
+                    raise RuntimeError('{} holds the outputs of another teacher ({}), use a new '
+                                       '--teacher-cache directory'.format(cache_dir, owner_path))
+        else:
+            with open(owner_path, 'w') as f:
+                f.write(owner)
+
+    def path(self, image_path):
+        return os.path.join(self.cache_dir, hashlib.sha1(image_path.encode()).hexdigest() + '.pt')
+
+    def build(self, teacher, dataset, batch_size=4, device='cpu'):
+        """Runs teacher on the frames of dataset (an LNFGeneratorTorch with
+        split='test') that are not cached yet."""
+        missing = [i for i in range(len(dataset)) if not os.path.exists(self.path(dataset._x_rgb[i]))]
+        if not missing:
+            return
+        loader = DataLoader(Subset(dataset, missing), batch_size=batch_size)
+        with torch.no_grad():
+            for sample in tqdm(loader, desc='teacher cache'):
+                image = sample['image'].to(device)
+                x, conf, _ = teacher(image, resolution='decoder')
+                maps = torch.cat((x, conf), dim=1).half().cpu()
+                for i, index in enumerate(sample['index'].tolist()):
+                    torch.save({'maps': maps[i].clone(), 'size': tuple(image.size()[2:])},
+                               self.path(dataset._x_rgb[index]))
+
+    def targets(self, sample, image_paths, size):
+        """Teacher logits and confidence for a training batch, resized to size."""
+        crop_h, crop_w = sample['image'].size()[2:]
+        maps = []
+        for i, image_path in enumerate(image_paths):
+            cached = torch.load(self.path(image_path))
+            # upsampled as in DeepLab.forward, so that any crop offset is exact
+            m = resize(cached['maps'].float().unsqueeze(0), cached['size'])[0]
+            if 'flip' in sample and sample['flip'][i]:
+                m = m.flip(2)
+            left = int(sample['crop_w'][i]) if 'crop_w' in sample else 0
+            maps.append(m[:, :crop_h, left:left + crop_w])
+        maps = resize(torch.stack(maps), size)
+        return maps[:, :-1], maps[:, -1:]
@@ -299,7 +299,8 @@ class LNFGeneratorTorch(Dataset):
             X_rgb = LNFGeneratorTorch._context_func_rgb(self._x_rgb[index])
             Y_mask = LNFGeneratorTorch._context_func_labels(self._y_mask[index])
             sample = {'image':Image.fromarray(np.asarray(X_rgb)),
-                      'label':Image.fromarray(np.asarray(Y_mask))}
+                      'label':Image.fromarray(np.asarray(Y_mask)),
+                      'index':index}
             if self.split == 'train':
                     return self.transform_tr(sample)
 
@@ -315,7 +316,8 @@ class LNFGeneratorTorch(Dataset):
             Y_mask = LNFGeneratorTorch._mergenet_func_labels(self._y_mask[index])
             X_ft = np.concatenate((np.asarray(X_rgb), np.asarray(X_disp)), axis=2)
             sample = {'image':Image.fromarray(X_ft),
-                      'label':Image.fromarray(np.asarray(Y_mask))}
+                      'label':Image.fromarray(np.asarray(Y_mask)),
+                      'index':index}
             if self.split == 'train':
                 return self.transform_tr_depth(sample)
             elif self.split == 'val':
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 class SegmentationLosses(object):
     def __init__(self,size_average=True, batch_average=True, ignore_index=255, cuda=False):
@@ -31,6 +32,82 @@ class SegmentationLosses(object):
 
         return loss
 
+    def LowResCrossEntropyLoss(self, logit, target, weight, boundary_weight=0.0):
+        """Cross entropy on decoder resolution logits.
+
+        The full resolution target is nearest-downsampled to the logit size.
+        If boundary_weight > 0, the logits are additionally sampled
+        (bilinear, align_corners=True, as F.interpolate in DeepLab.forward)
+        at the full resolution label boundaries only, so thin obstacles keep
+        a full resolution signal without materialising upsampled maps.
+        """
+        n, c, h, w = logit.size()
+        low_target = F.interpolate(target.unsqueeze(1).float(), size=(h, w),
+                                   mode='nearest').squeeze(1)
+        loss = self.CrossEntropyLoss(logit, low_target, weight)
+
+        if boundary_weight > 0:
+            loss = loss + boundary_weight * self.BoundaryLoss(logit, target, weight)
+
+        return loss
+
+    def BoundaryLoss(self, logit, target, weight):
+        n, c, h, w = logit.size()
+        H, W = target.size()[1:]
+        target = target.long()
+        # 4-neighbourhood label change marks a boundary pixel
+        edge = torch.zeros_like(target, dtype=torch.bool)
+        edge[:, 1:, :] |= target[:, 1:, :] != target[:, :-1, :]
+        edge[:, :-1, :] |= target[:, :-1, :] != target[:, 1:, :]
+        edge[:, :, 1:] |= target[:, :, 1:] != target[:, :, :-1]
+        edge[:, :, :-1] |= target[:, :, :-1] != target[:, :, 1:]
+
+        if weight is not None:
+            weight = weight.to(logit.device)
+        losses = []
+        for i in range(n):
+            ys, xs = torch.nonzero(edge[i], as_tuple=True)
+            if ys.numel() == 0:
+                continue
+            grid = torch.stack((xs.float() * 2 / max(W - 1, 1) - 1,
+                                ys.float() * 2 / max(H - 1, 1) - 1), dim=1)
+            grid = grid.to(logit.dtype).view(1, 1, -1, 2)
+            points = F.grid_sample(logit[i:i + 1], grid, mode='bilinear',
+                                   align_corners=True)
+            points = points.view(c, -1).t()
+            losses.append(F.cross_entropy(points, target[i, ys, xs], weight=weight,
+                                          ignore_index=self.ignore_index))
+        if not losses:
+            return logit.sum() * 0
+
+        loss = torch.stack(losses).mean()
+        if self.batch_average:
+            loss /= n
+
+        return loss
+
+    def DistillationLoss(self, logit, conf, teacher_logit, teacher_conf, temperature=1.0):
+        """Knowledge distillation loss against teacher outputs of the same size.
+
+        KL divergence between the temperature softened class distributions,
+        scaled by temperature**2 to keep the gradient magnitude independent of
+        the temperature, plus the binary KL divergence between the sigmoid
+        confidence maps.
+        """
+        n, c, h, w = logit.size()
+        log_p = F.log_softmax(logit / temperature, dim=1)
+        q = F.softmax(teacher_logit / temperature, dim=1)
+        loss = F.kl_div(log_p, q, reduction='none').sum(1).mean() * temperature ** 2
+
+        eps = 1e-6
+        p, q = conf.clamp(eps, 1 - eps), teacher_conf.clamp(eps, 1 - eps)
+        loss = loss + (q * (q.log() - p.log()) + (1 - q) * ((1 - q).log() - (1 - p).log())).mean()
+
+        if self.batch_average:
+            loss /= n
+
+        return loss
+
     def FocalLoss(self, logit, target, gamma=2, alpha=0.5):
         n, c, h, w = logit.size()
         criterion = nn.CrossEntropyLoss(weight=self.weight, ignore_index=self.ignore_index,
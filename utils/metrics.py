@@ -6,6 +6,7 @@ class Evaluator(object):
     def __init__(self, num_class):
         self.num_class = num_class
         self.confusion_matrix = np.zeros((self.num_class,)*2)
+        self.reduced = None
 
     def Pixel_Accuracy(self):
         Acc = np.diag(self.confusion_matrix).sum() / self.confusion_matrix.sum()
@@ -39,11 +40,7 @@ class Evaluator(object):
         confusion_matrix = count.reshape(self.num_class, self.num_class)
         return confusion_matrix
 
-    def pdr_metric(self,class_id):
-        """
-        Precision and recall metric for each class
-         class_id=2 for small obstacle [0-off road,1-on road]
-        """
+    def _pdr_counts(self, class_id):
         truth_mask=self.gt_labels==class_id
         pred_mask=self.pred_labels==class_id
 
@@ -52,6 +49,17 @@ class Evaluator(object):
 
         total=np.count_nonzero(truth_mask==True)
         pred=np.count_nonzero(pred_mask==True)
+        return true_positive, total, pred
+
+    def pdr_metric(self,class_id):
+        """
+        Precision and recall metric for each class
+         class_id=2 for small obstacle [0-off road,1-on road]
+        """
+        if self.reduced is not None and self.reduced['class_id'] == class_id:
+            true_positive, total, pred = self.reduced['pdr']
+        else:
+            true_positive, total, pred = self._pdr_counts(class_id)
 
         if total != 0:
             recall=float(true_positive/total)
@@ -79,6 +87,27 @@ class Evaluator(object):
         self.confusion_matrix = np.zeros((self.num_class,) * 2)
         self.gt_labels=[] 
         self.pred_labels=[]
+        self.reduced = None
+
+    def all_reduce(self, class_id=2, thresh=0.5):
+        """Sums the confusion matrix and the PDR/IDR counts of class_id over the
+        ranks of the default torch.distributed process group, so that every
+        rank reports the metrics of the whole data set. Call it once after the
+        last add_batch."""
+        import torch
+        import torch.distributed as dist
+        counts = np.concatenate([self.confusion_matrix.flatten(), self._pdr_counts(class_id),
+                                 self._idr_counts(class_id, thresh)])
+        counts = torch.from_numpy(counts.astype(np.float64))
+        if dist.get_backend() == 'nccl':
+            counts = counts.cuda()
+        dist.all_reduce(counts)
+        counts = counts.cpu().numpy()
+        n = self.num_class ** 2
+        self.confusion_matrix = counts[:n].reshape(self.num_class, self.num_class)
+        self.reduced = {'class_id': class_id, 'thresh': thresh,
+                        'pdr': tuple(int(c) for c in counts[n:n + 3]),
+                        'idr': tuple(int(c) for c in counts[n + 3:n + 5])}
 
     # def add_batch(self, gt_image, pre_image):
     #     assert gt_image.shape == pre_image.shape
@@ -88,6 +117,17 @@ class Evaluator(object):
     #     self.confusion_matrix = np.zeros((self.num_class,) * 2)
 
     def idr_metric(self, class_id, thresh=0.5):
+        if self.reduced is not None and (self.reduced['class_id'], self.reduced['thresh']) == (class_id, thresh):
+            true_positives, total = self.reduced['idr']
+        else:
+            true_positives, total = self._idr_counts(class_id, thresh)
+        if total != 0:
+            idr = true_positives/total
+        else:
+            idr = None
+        return idr
+
+    def _idr_counts(self, class_id, thresh=0.5):
 
         # get masks for the interested class
         truth_mask = self.gt_labels == class_id
@@ -139,11 +179,7 @@ class Evaluator(object):
                     true_positives+=1
 
         total = len(instance_ids) - 1
-        if total != 0:
-            idr = true_positives/(len(instance_ids) - 1)
-        else:
-            idr = None
-        return idr
+        return true_positives, total
 
 
 
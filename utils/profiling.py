@@ -0,0 +1,172 @@
+import collections
+import time
+import torch
+import torch.nn as nn
+
+
+class SavedTensorMeter(object):
+    """Counts the bytes autograd keeps alive for the backward pass.
+
+    Tensors sharing a storage are counted once, so the number is close to
+    the activation memory of a training step on any device.
+    """
+    def __init__(self):
+        self.nbytes = 0
+        self._storages = set()
+        self._hooks = None
+
+    def _pack(self, tensor):
+        storage = tensor.untyped_storage()
+        key = (storage.data_ptr(), tensor.device)
+        if key not in self._storages:
+            self._storages.add(key)
+            self.nbytes += storage.nbytes()
+        return tensor
+
+    def __enter__(self):
+        self.nbytes = 0
+        self._storages = set()
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda t: t)
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._hooks.__exit__(*exc)
+        self._storages = set()
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_call(fn, iters=10, warmup=2, device='cpu'):
+    """Returns the mean wall time of fn() in seconds."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def count_flops(model, *inputs):
+    """FLOPs (2 x multiply-accumulates) of the conv and linear layers in one
+    forward of model, per module name."""
+    flops = {}
+
+    def hook(name):
+        def count(module, input, output):
+            if isinstance(module, nn.Conv2d):
+                macs = output.numel() * module.in_channels // module.groups * \
+                    module.kernel_size[0] * module.kernel_size[1]
+            else:
+                macs = output.numel() * module.in_features
+            flops[name] = flops.get(name, 0) + 2 * macs
+        return count
+
+    handles = [m.register_forward_hook(hook(name)) for name, m in model.named_modules()
+               if isinstance(m, (nn.Conv2d, nn.Linear))]
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return flops
+
+
+def format_bytes(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nbytes) < 1024.0:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024.0
+    return '%.1f TB' % nbytes
+
+
+def _nbytes(output):
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(_nbytes(o) for o in output)
+    return 0
+
+
+def profile_modules(model, input, max_depth=2, methods=('gate_and_upsample',), iters=5, warmup=1,
+                    device='cpu'):
+    """Per-module wall time, FLOPs, parameters and output activation bytes of
+    model(input), for the modules up to max_depth levels below the model and
+    for the listed model methods.
+
+    Returns rows in the order the modules are entered, each a dict with name, calls (per forward),
+    time_ms (inclusive of submodules, mean per forward), flops, params and
+    activation_bytes (outputs of one forward), followed by a 'total' row
+    with the time and outputs of the whole forward.
+    """
+    flops = count_flops(model, input)
+    stats = collections.OrderedDict()
+    starts = collections.defaultdict(list)
+    state = {'record': False}
+
+    def row(name, module=None):
+        if name not in stats:
+            stats[name] = {'name': name, 'calls': 0, 'time_ms': 0.0,
+                           'flops': sum(v for k, v in flops.items() if k == name or k.startswith(name + '.')),
+                           'params': sum(p.numel() for p in module.parameters()) if module is not None else 0,
+                           'activation_bytes': 0}
+        return stats[name]
+
+    def enter(name, module=None):
+        if state['record']:
+            row(name, module)
+        synchronize(device)
+        starts[name].append(time.perf_counter())
+
+    def leave(name, output):
+        synchronize(device)
+        elapsed = time.perf_counter() - starts[name].pop()
+        if state['record']:
+            r = stats[name]
+            r['calls'] += 1
+            r['time_ms'] += elapsed * 1000
+            r['activation_bytes'] += _nbytes(output)
+
+    handles = []
+    for name, module in model.named_modules():
+        if name and name.count('.') < max_depth:
+            handles.append(module.register_forward_pre_hook(lambda m, i, name=name: enter(name, m)))
+            handles.append(module.register_forward_hook(lambda m, i, o, name=name: leave(name, o)))
+
+    def timed(name, fn):
+        def wrapper(*args, **kwargs):
+            enter(name)
+            output = fn(*args, **kwargs)
+            leave(name, output)
+            return output
+        return wrapper
+
+    # an instance attribute shadows the method for the duration of the profile
+    for method in methods:
+        setattr(model, method, timed(method, getattr(model, method)))
+    try:
+        with torch.no_grad():
+            output = model(input)
+            for _ in range(warmup - 1):
+                model(input)
+            state['record'] = True
+            total = time_call(lambda: model(input), iters=iters, warmup=0, device=device)
+    finally:
+        for handle in handles:
+            handle.remove()
+        for method in methods:
+            delattr(model, method)
+
+    rows = []
+    for r in stats.values():
+        rows.append(dict(r, calls=r['calls'] // iters, time_ms=r['time_ms'] / iters,
+                         activation_bytes=r['activation_bytes'] // iters))
+    rows.append({'name': 'total', 'calls': 1, 'time_ms': total * 1000, 'flops': sum(flops.values()),
+                 'params': sum(p.numel() for p in model.parameters()), 'activation_bytes': _nbytes(output)})
+    return rows
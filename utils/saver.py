@@ -1,49 +1,206 @@
+import atexit
+import contextlib
+import fcntl
+import json
 import os
+import queue
 import shutil
+import threading
 import torch
 from collections import OrderedDict
 import glob
 
+
+def snapshot(obj, memo=None):
+    """Copy of a (nested) state dict with all tensors copied to host memory.
+    Entries aliasing the same tensor (e.g. the parameters of a module
+    registered under two names) stay shared, as in torch.save."""
+    memo = {} if memo is None else memo
+    if torch.is_tensor(obj):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), obj.size(), obj.stride(), obj.dtype)
+        if key not in memo:
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v, memo)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, memo) for v in obj)
+    return obj
+
+
+def atomic_save(obj, filename):
+    """torch.save to a temporary file, renamed over filename when complete."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def link_or_copy(src, dst):
+    """Atomically points dst at the current content of src: a hard link, which
+    keeps that content when src is replaced later, or a copy where the file
+    system has no hard links."""
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class RunRegistry(object):
+    """Run ids and best metrics of the experiment_* runs of a directory.
+
+    Kept in registry.json, which is read and atomically replaced under an
+    exclusive flock of registry.lock, so concurrent jobs get distinct run ids
+    and see each other's best metrics. A directory without a registry is
+    indexed once from its experiment_*/best_pred.txt files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'registry.json')
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self.directory, 'registry.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self._read()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        best_pred = {}
+        for run in glob.glob(os.path.join(self.directory, 'experiment_*')):
+            run_id = run.split('_')[-1]
+            if not run_id.isdigit():
+                continue
+            path = os.path.join(run, 'best_pred.txt')
+            best_pred[run_id] = None
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    best_pred[run_id] = float(f.readline())
+        return {'next_run': max([int(run_id) + 1 for run_id in best_pred] + [0]), 'best_pred': best_pred}
+
+    def _write(self, registry):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(registry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def new_run(self):
+        """Allocates the next run id."""
+        with self._locked() as registry:
+            run_id = registry['next_run']
+            registry['next_run'] = run_id + 1
+            registry['best_pred'][str(run_id)] = None
+            self._write(registry)
+        return run_id
+
+    def update_best(self, run_id, best_pred):
+        """Records the best metric of a run, returns whether it beats all other runs."""
+        with self._locked() as registry:
+            others = [pred for other, pred in registry['best_pred'].items() if other != str(run_id)]
+            is_best = not others or best_pred > max([0.0] + [pred for pred in others if pred is not None])
+            registry['best_pred'][str(run_id)] = best_pred
+            self._write(registry)
+        return is_best
+
+
 class Saver(object):
+    """Experiment directory and checkpoint writer.
+
+    Checkpoints are snapshotted to host memory in the training loop and
+    written by a background thread. At most max_pending snapshots wait for
+    the writer (save_checkpoint blocks when the queue is full), so the host
+    memory is bounded. With max_pending=0 checkpoints are written in the
+    calling thread. An error of the writer is raised by the next
+    save_checkpoint or by close().
+    """
 
-    def __init__(self, args):
+    def __init__(self, args, max_pending=1):
         self.args = args
         if args.debug:
             self.directory = os.path.join('./logs/run/debug/', args.dataset, args.checkname)
         else:
             self.directory = os.path.join('./logs/run/',
                                           args.logsFlag, args.dataset, args.checkname)
-        self.runs = sorted(glob.glob(os.path.join(self.directory, 'experiment_*')))
-        run_id = int(self.runs[-1].split('_')[-1]) + 1 if self.runs else 0
+        self.registry = RunRegistry(self.directory)
+        self.run_id = self.registry.new_run()
 
-        self.experiment_dir = os.path.join(self.directory, 'experiment_{}'.format(str(run_id)))
+        self.experiment_dir = os.path.join(self.directory, 'experiment_{}'.format(str(self.run_id)))
         if not os.path.exists(self.experiment_dir):
             os.makedirs(self.experiment_dir)
 
+        self._queue = None
+        self._error = None
+        if max_pending > 0:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._writer = threading.Thread(target=self._run, daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is not None and self._error is None:
+                    self._write(*job)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+            if job is None:
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint to {} failed'.format(self.experiment_dir)) from error
+
     def save_checkpoint(self, state, is_best, filename='checkpoint.pth.tar'):
-        """Saves checkpoint to disk"""
+        """Saves checkpoint to disk, from a background thread unless max_pending=0"""
+        self._raise_error()
         filename = os.path.join(self.experiment_dir, filename)
-        torch.save(state, filename)
+        if self._queue is None:
+            self._write(state, is_best, filename)
+        else:
+            self._queue.put((snapshot(state), is_best, filename))
+
+    def wait(self):
+        """Blocks until the queued checkpoints are written."""
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes the queued checkpoints and stops the writer thread."""
+        if self._queue is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        self._raise_error()
+
+    def _write(self, state, is_best, filename):
+        atomic_save(state, filename)
         if is_best:
             best_pred = state['best_pred']
             with open(os.path.join(self.experiment_dir, 'best_pred.txt'), 'w') as f:
                 f.write(str(best_pred))
-            if self.runs:
-                previous_miou = [0.0]
-                for run in self.runs:
-                    run_id = run.split('_')[-1]
-                    path = os.path.join(self.directory, 'experiment_{}'.format(str(run_id)), 'best_pred.txt')
-                    if os.path.exists(path):
-                        with open(path, 'r') as f:
-                            miou = float(f.readline())
-                            previous_miou.append(miou)
-                    else:
-                        continue
-                max_miou = max(previous_miou)
-                if best_pred > max_miou:
-                    shutil.copyfile(filename, os.path.join(self.experiment_dir, 'model_best.pth.tar'))
-            else:
-                shutil.copyfile(filename, os.path.join(self.experiment_dir, 'model_best.pth.tar'))
+            # model_best only for a run better than all other runs of the directory
+            if self.registry.update_best(self.run_id, best_pred):
+                link_or_copy(filename, os.path.join(self.experiment_dir, 'model_best.pth.tar'))
 
     def save_experiment_config(self):
         logfile = os.path.join(self.experiment_dir, 'parameters.txt')
@@ -4,6 +4,12 @@ from torchvision.utils import make_grid
 from tensorboardX import SummaryWriter
 from dataloaders.utils import decode_seg_map_sequence, decode_confidence_map_sequence
 
+class NullSummaryWriter(object):
+    """Drops everything written to it, the writer of the ranks > 0 in distributed training."""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
 class TensorboardSummary(object):
     def __init__(self, directory):
         self.directory = directory